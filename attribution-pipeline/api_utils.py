@@ -5,17 +5,232 @@ This module provides functions for interacting with the IHC Attribution API,
 including authentication, sending data, and processing responses.
 """
 
+import numpy as np
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
+import gzip
+import hashlib
 import logging
+import threading
 import time
-from typing import List, Dict, Any, Optional, Tuple
+from collections import deque
+from functools import lru_cache
+from operator import itemgetter
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Tuple, Mapping, Union, Iterable, Sized
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from config import IHC_API_KEY, IHC_CONV_TYPE_ID, API_MAX_RETRIES, API_RETRY_DELAY
+from config import (
+    IHC_API_KEY, IHC_CONV_TYPE_ID, API_MAX_RETRIES, API_RETRY_DELAY, API_MAX_CONCURRENCY,
+    API_RPM_LIMIT, API_TARGET_LATENCY, API_REQUESTS_PER_SECOND, API_CACHE_DIR,
+    DEBUG_SAVE_RESPONSES, API_RESPONSE_DIR
+)
 
 from config import logger
 
+# API result fields and the attribution_customer_journey columns they map to
+_get_result_fields = itemgetter('conversion_id', 'session_id', 'ihc')
+_RESULT_FIELDS = ('conv_id', 'session_id', 'ihc')
+
+@lru_cache(maxsize=256)
+def _read_cached_response(cache_path: str) -> Dict[str, Any]:
+    """
+    Read and decode a cached API response.
+    
+    Decoded responses are kept in memory so repeated hits skip deserialization.
+    Misses raise FileNotFoundError and corrupt files ValueError; lru_cache memoizes
+    neither, so a repaired entry is read again.
+    
+    Args:
+        cache_path: Path of the cache file
+        
+    Returns:
+        Dictionary with the cached API response
+    """
+    return orjson.loads(Path(cache_path).read_bytes())
+
+def _write_cached_response(cache_path: Path, content: bytes) -> None:
+    """
+    Atomically write a raw API response to the cache.
+    
+    Args:
+        cache_path: Path of the cache file
+        content: Raw response body
+    """
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # Unique temporary name so concurrent workers never write the same file
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        # Caching is an optimization only; never fail the request because of it
+        logger.warning(f"Could not write API response cache {cache_path}: {e}")
+
+class Throttle:
+    """
+    Adaptive concurrency limiter for API requests.
+    
+    Uses additive-increase/multiplicative-decrease (AIMD): the number of requests
+    allowed in flight grows slowly while the API responds quickly and is halved
+    when it signals pressure (low remaining quota, slow responses, 429/5xx).
+    A sliding one-minute window additionally enforces a requests-per-minute limit,
+    seeded from the API's rate limit headers when present.
+    """
+    
+    WINDOW_SECONDS = 60.0
+    
+    def __init__(
+        self,
+        max_concurrency: int = API_MAX_CONCURRENCY,
+        rpm_limit: int = API_RPM_LIMIT,
+        target_latency: float = API_TARGET_LATENCY,
+        increase_step: float = 0.5,
+        decrease_factor: float = 0.5
+    ):
+        """
+        Initialize the throttle.
+        
+        Args:
+            max_concurrency: Upper bound on requests in flight
+            rpm_limit: Maximum requests per minute (0 disables the limit until
+                the API reports one)
+            target_latency: Response time in seconds above which concurrency is reduced
+            increase_step: Concurrency added after each fast, successful response
+            decrease_factor: Factor concurrency is multiplied by under pressure
+        """
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = float(self.max_concurrency)
+        self.rpm_limit = rpm_limit
+        self.target_latency = target_latency
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        
+        self._request_times = deque()
+        self._in_flight = 0
+        self._blocked_until = 0.0
+        self._condition = threading.Condition()
+    
+    def _wait_time(self, now: float) -> float:
+        """Return how long a new request has to wait, or 0 if it can start now."""
+        # Drop timestamps that have left the sliding window
+        while self._request_times and now - self._request_times[0] >= self.WINDOW_SECONDS:
+            self._request_times.popleft()
+        
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        if self.rpm_limit and len(self._request_times) >= self.rpm_limit:
+            return self._request_times[0] + self.WINDOW_SECONDS - now
+        return 0.0
+    
+    def wait_if_throttled(self) -> None:
+        """Block until a request slot is free, then claim it."""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                wait = self._wait_time(now)
+                if wait <= 0 and self._in_flight < int(self.concurrency):
+                    break
+                # Woken early by release() when a slot frees up
+                self._condition.wait(timeout=wait if wait > 0 else None)
+            
+            self._in_flight += 1
+            self._request_times.append(now)
+    
+    def release(
+        self,
+        latency: float,
+        headers: Optional[Mapping[str, str]] = None,
+        throttled: bool = False
+    ) -> None:
+        """
+        Release a request slot and adapt concurrency to the observed response.
+        
+        Args:
+            latency: Response time of the request in seconds
+            headers: Response headers, if a response was received
+            throttled: True if the request failed with a 429/5xx or transport error
+        """
+        with self._condition:
+            self._in_flight -= 1
+            
+            headers = headers or {}
+            pressure = throttled or latency > self.target_latency
+            
+            # Seed the request budget from the API's rate limit headers
+            limit = _parse_header_number(headers.get('x-ratelimit-limit-requests'))
+            if limit:
+                self.rpm_limit = int(limit)
+            remaining = _parse_header_number(headers.get('x-ratelimit-remaining-requests'))
+            if remaining is not None and limit and remaining < 0.1 * limit:
+                pressure = True
+            
+            retry_after = _parse_header_number(headers.get('Retry-After'))
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+            
+            if pressure:
+                self.concurrency = max(1.0, self.concurrency * self.decrease_factor)
+                logger.info(f"API under pressure, reducing concurrency to {int(self.concurrency)}")
+            else:
+                self.concurrency = min(float(self.max_concurrency), self.concurrency + self.increase_step)
+            
+            self._condition.notify_all()
+
+def _parse_header_number(value: Optional[str]) -> Optional[float]:
+    """Parse a numeric header value, returning None if missing or not a number."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+class TokenBucket:
+    """
+    Token bucket rate limiter.
+    
+    Tokens refill continuously at `rate` per second up to `capacity`; each request
+    takes one token, so short bursts of up to `capacity` requests are allowed while
+    the long-run request rate stays at `rate`.
+    """
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """
+        Initialize the token bucket.
+        
+        Args:
+            rate: Tokens added per second (0 or less disables rate limiting)
+            capacity: Maximum number of tokens (defaults to max(1, rate))
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self) -> None:
+        """Block until a token is available, then take it."""
+        if self.rate <= 0:
+            return
+        
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+                
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                
+                wait = (1 - self._tokens) / self.rate
+            
+            time.sleep(wait)
+
 class IHCApiClient:
     """Client for interacting with the IHC Attribution API."""
     
@@ -25,7 +240,10 @@ class IHCApiClient:
         conv_type_id: str,
         base_url: str = "https://api.ihc-attribution.com/v1",
         max_retries: int = API_MAX_RETRIES,
-        retry_delay: int = API_RETRY_DELAY
+        retry_delay: int = API_RETRY_DELAY,
+        max_concurrency: int = API_MAX_CONCURRENCY,
+        requests_per_second: float = API_REQUESTS_PER_SECOND,
+        cache_dir: Optional[str] = API_CACHE_DIR
     ):
         """
         Initialize the IHC API client.
@@ -36,12 +254,18 @@ class IHCApiClient:
             base_url: Base URL for the API
             max_retries: Maximum number of retries for failed requests
             retry_delay: Delay between retries in seconds
+            max_concurrency: Maximum number of requests in flight at once
+            requests_per_second: Sustained request rate limit (0 disables it)
+            cache_dir: Directory for cached API responses (None or empty disables caching)
         """
         self.api_key = api_key
         self.conv_type_id = conv_type_id
         self.base_url = base_url
         self.max_retries = max_retries
         self.retry_delay = retry_delay
+        self.throttle = Throttle(max_concurrency)
+        self.rate_limiter = TokenBucket(requests_per_second, capacity=max(1, max_concurrency))
+        self.cache_dir = Path(cache_dir) if cache_dir else None
         
         # Validate API key
         if not api_key:
@@ -51,8 +275,35 @@ class IHCApiClient:
         if not conv_type_id:
             raise ValueError("Conversion type ID is required")
         
+        # Reuse pooled connections across requests instead of a new TCP+TLS handshake per chunk
+        self.session = requests.Session()
+        self.session.headers.update(self.get_headers())
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=32,
+            max_retries=Retry(
+                total=max_retries,
+                backoff_factor=retry_delay,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(["POST"]),
+                respect_retry_after_header=True,
+                raise_on_status=False
+            )
+        )
+        self.session.mount("https://", adapter)
+        
         logger.info(f"Initialized IHC API client with conversion type ID: {conv_type_id}")
     
+    def __enter__(self) -> "IHCApiClient":
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+    
+    def close(self) -> None:
+        """Close the underlying HTTP session and release pooled connections."""
+        self.session.close()
+    
     def get_headers(self) -> Dict[str, str]:
         """
         Get headers for API requests.
@@ -95,47 +346,101 @@ class IHCApiClient:
         if redistribution_parameter:
             body['redistribution_parameter'] = redistribution_parameter
         
-        # Log request details
-        logger.info(f"Sending request to {url} with {len(customer_journeys)} sessions")
+        # Serialize exactly once: the canonical (sorted-key) bytes are both the request
+        # payload and the input of the cache key. The session already sends the JSON
+        # Content-Type header
+        data = orjson.dumps(body, option=orjson.OPT_SORT_KEYS)
         
-        # Send request with retry logic
-        for attempt in range(self.max_retries):
+        # Return a cached response if these exact journeys were computed before
+        cache_path = self._get_cache_path(data)
+        if cache_path is not None:
             try:
-                response = requests.post(
-                    url,
-                    headers=self.get_headers(),
-                    data=json.dumps(body)
-                )
-                
-                # Check if request was successful
-                response.raise_for_status()
-                
-                # Parse response
-                result = response.json()
-                
-                # Check for API errors
-                if result.get('statusCode') not in [200, 206]:
-                    error_msg = f"API error: {result.get('statusCode')} - {result.get('message', 'Unknown error')}"
-                    logger.error(error_msg)
-                    raise ValueError(error_msg)
-                
-                # Log partial failures if any
-                partial_failures = result.get('partialFailureErrors', [])
-                if partial_failures:
-                    logger.warning(f"API returned {len(partial_failures)} partial failures")
-                    for failure in partial_failures:
-                        logger.warning(f"Partial failure: {failure}")
-                
-                logger.info(f"Successfully computed IHC for {len(customer_journeys)} sessions")
+                result = _read_cached_response(str(cache_path))
+                logger.info(f"Using cached IHC response for {len(customer_journeys)} sessions")
                 return result
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                # An unreadable or corrupt entry is a miss too; the fresh response replaces it
+                logger.warning(f"Ignoring unreadable API response cache {cache_path}: {e}")
+        
+        # Log request details
+        logger.info(f"Sending request to {url} with {len(customer_journeys)} sessions")
+        
+        # Retries with exponential backoff (honoring Retry-After) for connection errors and
+        # 429/5xx responses are handled by the session adapter; API errors are not retried
+        self.rate_limiter.acquire()
+        self.throttle.wait_if_throttled()
+        start_time = time.monotonic()
+        response = None
+        try:
+            response = self.session.post(url, data=data, timeout=(5, 60))
+        except requests.RequestException as e:
+            logger.error(f"Request failed: {e}")
+            raise
+        finally:
+            # Always hand the slot back, whatever escapes the request; no response
+            # at all counts as pressure
+            self.throttle.release(
+                time.monotonic() - start_time,
+                response.headers if response is not None else None,
+                throttled=response is None or response.status_code == 429 or response.status_code >= 500
+            )
+        
+        # Check if request was successful
+        try:
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            logger.error(f"Request failed: {e}")
+            raise
+        
+        # Parse response
+        result = orjson.loads(response.content)
+        
+        # Check for API errors
+        if result.get('statusCode') not in [200, 206]:
+            error_msg = f"API error: {result.get('statusCode')} - {result.get('message', 'Unknown error')}"
+            logger.error(error_msg)
+            raise ValueError(error_msg)
+        
+        # Log partial failures if any
+        partial_failures = result.get('partialFailureErrors', [])
+        if partial_failures:
+            logger.warning(f"API returned {len(partial_failures)} partial failures")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Partial failures: {orjson.dumps(partial_failures).decode()}")
+        
+        logger.info(f"Successfully computed IHC for {len(customer_journeys)} sessions")
+        
+        if DEBUG_SAVE_RESPONSES:
+            save_api_response(response.content, API_RESPONSE_DIR)
+        
+        # Only fully successful responses are cached; partial failures should be retried
+        if cache_path is not None and result.get('statusCode') == 200:
+            _write_cached_response(cache_path, response.content)
+        
+        return result
+    
+    def _get_cache_path(self, data: bytes) -> Optional[Path]:
+        """
+        Get the cache file path for a serialized request body.
+        
+        The key is a hash of the conversion type ID together with the request bytes,
+        serialized with sorted keys, so identical journeys map to the same file.
+        
+        Args:
+            data: Request body serialized with sorted keys
             
-            except (requests.RequestException, ValueError) as e:
-                if attempt < self.max_retries - 1:
-                    logger.warning(f"Request failed (attempt {attempt + 1}/{self.max_retries}): {e}")
-                    time.sleep(self.retry_delay)
-                else:
-                    logger.error(f"Request failed after {self.max_retries} attempts: {e}")
-                    raise
+        Returns:
+            Path of the cache file, or None if caching is disabled
+        """
+        if self.cache_dir is None:
+            return None
+        
+        digest = hashlib.blake2b(self.conv_type_id.encode(), digest_size=16)
+        digest.update(b'\0')
+        digest.update(data)
+        return self.cache_dir / f"{digest.hexdigest()}.json"
     
     def process_ihc_results(
         self, 
@@ -150,78 +455,130 @@ class IHCApiClient:
         Returns:
             List of dictionaries with processed attribution results
         """
-        # Extract attribution results
-        attribution_results = api_response.get('value', [])
-        
-        # Process results
-        processed_results = []
-        for result in attribution_results:
-            processed_result = {
-                'conv_id': result['conversion_id'],
-                'session_id': result['session_id'],
-                'ihc': result['ihc']
-            }
-            processed_results.append(processed_result)
+        # Extract attribution results and rename API fields to the table's columns
+        processed_results = [
+            dict(zip(_RESULT_FIELDS, _get_result_fields(result)))
+            for result in api_response.get('value', ())
+        ]
         
         logger.info(f"Processed {len(processed_results)} attribution results")
         return processed_results
 
+def _send_chunk(
+    api_client: IHCApiClient,
+    chunk: List[Dict[str, Any]],
+    chunk_index: int,
+    total_chunks: Optional[int]
+) -> List[Dict[str, Any]]:
+    """
+    Send a single validated journey chunk to the API and process the results.
+    
+    Args:
+        api_client: IHC API client
+        chunk: Journey chunk to send
+        chunk_index: Zero-based index of the chunk (for logging)
+        total_chunks: Total number of chunks, if known (for logging)
+        
+    Returns:
+        List of dictionaries with attribution results for the chunk
+    """
+    position = f"{chunk_index+1}/{total_chunks}" if total_chunks is not None else f"{chunk_index+1}"
+    logger.info(f"Processing chunk {position} with {len(chunk)} sessions")
+    
+    # Send to API
+    response = api_client.compute_ihc(chunk)
+    
+    # Process results
+    return api_client.process_ihc_results(response)
+
 def send_journeys_to_api(
     api_client: IHCApiClient,
-    journey_chunks: List[List[Dict[str, Any]]],
-    rate_limit_delay: float = 1.0
+    journey_chunks: Iterable[List[Dict[str, Any]]],
+    rate_limit_delay: Optional[float] = None,
+    max_concurrency: int = API_MAX_CONCURRENCY
 ) -> List[Dict[str, Any]]:
     """
     Send journey chunks to the API and collect results.
     
+    Works as a producer/consumer pipeline: the calling thread validates chunks and
+    hands valid ones to a pool of up to max_concurrency worker threads that send
+    them over the client's pooled session, so validating the next chunk overlaps
+    with requests already in flight. At most 2 * max_concurrency chunks are queued
+    ahead of the workers, so chunks can be produced lazily by a generator. The
+    client's token bucket and throttle keep the request rate within the API's
+    limits. Results are collected as chunks complete.
+    
     Args:
         api_client: IHC API client
-        journey_chunks: List of journey chunks
-        rate_limit_delay: Delay between API requests in seconds
+        journey_chunks: Journey chunks (a list or any other iterable)
+        rate_limit_delay: Deprecated; minimum delay between sending chunks in seconds.
+            Set requests_per_second on the client instead
+        max_concurrency: Maximum number of requests in flight at once
         
     Returns:
         List of dictionaries with attribution results
     """
+    from journey_builder import validate_journey_data
+    
     all_results = []
+    total_chunks = len(journey_chunks) if isinstance(journey_chunks, Sized) else None
+    chunk_count = 0
+    max_workers = max(1, max_concurrency)
     
-    for i, chunk in enumerate(journey_chunks):
-        try:
-            logger.info(f"Processing chunk {i+1}/{len(journey_chunks)} with {len(chunk)} sessions")
+    # Bounds the number of validated chunks waiting for a worker
+    pending_slots = threading.BoundedSemaphore(2 * max_workers)
+    
+    # The old fixed delay between requests is a rate limit of 1 / delay without bursts
+    delay_limiter = None
+    if rate_limit_delay is not None:
+        logger.warning("rate_limit_delay is deprecated, set requests_per_second on the API client instead")
+        delay_limiter = TokenBucket(1 / rate_limit_delay if rate_limit_delay > 0 else 0, capacity=1)
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        
+        for i, chunk in enumerate(journey_chunks):
+            chunk_count += 1
             
             # Validate journey data
-            from journey_builder import validate_journey_data
-            if not validate_journey_data(chunk):
-                logger.error(f"Invalid journey data in chunk {i+1}")
+            try:
+                if not validate_journey_data(chunk):
+                    logger.error(f"Invalid journey data in chunk {i+1}")
+                    continue
+            except Exception as e:
+                logger.error(f"Error validating chunk {i+1}: {e}")
                 continue
             
-            # Send to API
-            response = api_client.compute_ihc(chunk)
-            
-            # Process results
-            results = api_client.process_ihc_results(response)
-            all_results.extend(results)
-            
-            # Respect rate limits
-            if i < len(journey_chunks) - 1:
-                time.sleep(rate_limit_delay)
-                
-        except Exception as e:
-            logger.error(f"Error processing chunk {i+1}: {e}")
-            # Continue with next chunk
+            pending_slots.acquire()
+            if delay_limiter is not None:
+                delay_limiter.acquire()
+            future = executor.submit(_send_chunk, api_client, chunk, i, total_chunks)
+            future.add_done_callback(lambda _: pending_slots.release())
+            futures[future] = i
+        
+        for future in as_completed(futures):
+            try:
+                all_results.extend(future.result())
+            except Exception as e:
+                logger.error(f"Error processing chunk {futures[future]+1}: {e}")
+                # Continue with next chunk
     
-    logger.info(f"Processed {len(all_results)} attribution results from {len(journey_chunks)} chunks")
+    logger.info(f"Processed {len(all_results)} attribution results from {chunk_count} chunks")
     return all_results
 
 def save_api_response(
-    response: Dict[str, Any],
+    response: Union[Dict[str, Any], bytes],
     output_dir: str,
     prefix: str = "ihc_response"
 ) -> str:
     """
     Save API response to a file for debugging or auditing.
     
+    Responses are written as compact gzip-compressed JSON. Raw response bytes are
+    compressed as received, without a decode/encode round trip.
+    
     Args:
-        response: API response
+        response: API response, either decoded or as the raw response body
         output_dir: Directory to save the file
         prefix: Prefix for the filename
         
@@ -231,14 +588,15 @@ def save_api_response(
     # Create output directory if it doesn't exist
     os.makedirs(output_dir, exist_ok=True)
     
-    # Generate filename with timestamp
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"{prefix}_{timestamp}.json"
+    # Generate filename with timestamp (microseconds keep concurrent saves apart)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    filename = f"{prefix}_{timestamp}.json.gz"
     filepath = os.path.join(output_dir, filename)
     
-    # Save response
-    with open(filepath, 'w') as f:
-        json.dump(response, f, indent=2)
+    # Save response; compression level 1 is nearly as fast as a plain write
+    content = response if isinstance(response, bytes) else orjson.dumps(response)
+    with gzip.open(filepath, 'wb', compresslevel=1) as f:
+        f.write(content)
     
     logger.info(f"Saved API response to {filepath}")
     return filepath
@@ -257,25 +615,35 @@ def validate_api_results(attribution_results: List[Dict[str, Any]]) -> bool:
     Returns:
         True if results are valid, False otherwise
     """
-    required_fields = ['conv_id', 'session_id', 'ihc']
-    
-    for i, result in enumerate(attribution_results):
-        # Check required fields
-        for field in required_fields:
-            if field not in result:
-                logger.error(f"Result {i} missing required field: {field}")
-                return False
-        
-        # Check IHC value
-        if not 0 <= result['ihc'] <= 1:
-            logger.error(f"Result {i} has invalid IHC value: {result['ihc']}")
-            return False
+    required_fields = {'conv_id', 'session_id', 'ihc'}
     
     # Check if there are any results
     if not attribution_results:
         logger.warning("No attribution results to validate")
         return False
     
+    # Check required fields, stopping at the first incomplete result
+    first_invalid = next(
+        (i for i, result in enumerate(attribution_results) if not required_fields.issubset(result)),
+        None
+    )
+    if first_invalid is not None:
+        missing = sorted(required_fields - attribution_results[first_invalid].keys())
+        logger.error(f"Result {first_invalid} missing required fields: {missing}")
+        return False
+    
+    # Check IHC values in a single vectorized pass
+    ihc_values = np.fromiter(
+        (result['ihc'] for result in attribution_results),
+        dtype=np.float64,
+        count=len(attribution_results)
+    )
+    invalid = ~((ihc_values >= 0) & (ihc_values <= 1))
+    if invalid.any():
+        i = int(np.argmax(invalid))
+        logger.error(f"Result {i} has invalid IHC value: {attribution_results[i]['ihc']}")
+        return False
+    
     logger.info(f"Validated {len(attribution_results)} attribution results")
     return True
 
@@ -41,3 +41,15 @@ CREATE TABLE IF NOT EXISTS channel_reporting (
                             ihc_revenue real NOT NULL,
                             PRIMARY KEY(channel_name,date)
                         );
+
+CREATE TABLE IF NOT EXISTS cr_metadata (
+                            key text PRIMARY KEY,
+                            value text NOT NULL
+                        );
+
+CREATE INDEX IF NOT EXISTS idx_ss_user_ts ON session_sources(user_id, event_date, event_time);
+-- Covers the date filter, grouping and session join of the channel reporting query;
+-- it also serves plain event_date filters, which made idx_ss_event_date redundant
+CREATE INDEX IF NOT EXISTS idx_ss_date_chan_sid ON session_sources(event_date, channel_name, session_id);
+DROP INDEX IF EXISTS idx_ss_event_date;
+CREATE INDEX IF NOT EXISTS idx_acj_session_conv ON attribution_customer_journey(session_id, conv_id, ihc);
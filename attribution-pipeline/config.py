@@ -1,6 +1,10 @@
 # attribution-pipeline/config.py
 import os
+import atexit
 import logging
+import logging.handlers
+import multiprocessing
+import queue
 import sys
 
 # API Configuration
@@ -16,14 +20,51 @@ REPORT_OUTPUT_PATH = os.environ.get('REPORT_OUTPUT_PATH', 'channel_reporting.csv
 # API Rate Limiting
 API_MAX_RETRIES = int(os.environ.get('API_MAX_RETRIES', '3'))
 API_RETRY_DELAY = int(os.environ.get('API_RETRY_DELAY', '2'))
+API_MAX_CONCURRENCY = int(os.environ.get('API_MAX_CONCURRENCY', '8'))
+API_RPM_LIMIT = int(os.environ.get('API_RPM_LIMIT', '0'))
+API_TARGET_LATENCY = float(os.environ.get('API_TARGET_LATENCY', '10'))
+API_REQUESTS_PER_SECOND = float(os.environ.get('API_REQUESTS_PER_SECOND', '2'))
+
+# Journey Building (processes used when there is more than one batch of conversions)
+JOURNEY_WORKERS = int(os.environ.get('JOURNEY_WORKERS', str(os.cpu_count() or 1)))
+
+# API Response Cache (set to an empty string to disable)
+API_CACHE_DIR = os.environ.get('API_CACHE_DIR', '.ihc_cache')
+
+# Debugging: save every raw API response (gzip-compressed) to API_RESPONSE_DIR
+DEBUG_SAVE_RESPONSES = os.environ.get('DEBUG_SAVE_RESPONSES', '').lower() in ('1', 'true', 'yes')
+API_RESPONSE_DIR = os.environ.get('API_RESPONSE_DIR', 'api_responses')
 
 # Logging Configuration
 LOG_FILE = os.environ.get('LOG_FILE', 'attribution_pipeline.log')
 LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
 
+# Handlers that write the log records, owned by the main process
+_LOG_HANDLERS = []
+
 # Configure logging
 def setup_logging():
-    """Set up logging configuration for the entire application."""
+    """
+    Set up logging configuration for the entire application.
+    
+    Log records are handed to a queue and written to the file and console by a
+    background listener thread, so logging never blocks the calling thread on I/O.
+    
+    Only the main process opens the log file and starts the listener. Worker processes
+    re-import this module when they are spawned and send their records to the main
+    process instead (see init_worker_logging).
+    """
+    # Configure root logger
+    root_logger = logging.getLogger()
+    root_logger.setLevel(getattr(logging, LOG_LEVEL))
+    
+    # Remove any existing handlers to avoid duplicates
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    
+    if multiprocessing.current_process().name != 'MainProcess':
+        return root_logger
+    
     # Create a formatter
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     
@@ -34,20 +75,47 @@ def setup_logging():
     # Create console handler
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setFormatter(formatter)
+    _LOG_HANDLERS.extend([file_handler, console_handler])
     
-    # Configure root logger
-    root_logger = logging.getLogger()
-    root_logger.setLevel(getattr(logging, LOG_LEVEL))
-    
-    # Remove any existing handlers to avoid duplicates
-    for handler in root_logger.handlers[:]:
-        root_logger.removeHandler(handler)
+    # Write records from a background thread
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *_LOG_HANDLERS)
+    listener.start()
+    # Flush remaining records on interpreter exit
+    atexit.register(listener.stop)
     
     # Add handlers
-    root_logger.addHandler(file_handler)
-    root_logger.addHandler(console_handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
     
     return root_logger
 
+def start_worker_log_listener(log_queue) -> logging.handlers.QueueListener:
+    """
+    Write the records worker processes put on log_queue with the main process's handlers.
+    
+    Args:
+        log_queue: A multiprocessing queue shared with the workers
+        
+    Returns:
+        The started listener; stop it once the workers have exited
+    """
+    listener = logging.handlers.QueueListener(log_queue, *_LOG_HANDLERS)
+    listener.start()
+    return listener
+
+def init_worker_logging(log_queue) -> None:
+    """
+    Send a worker process's log records to the main process.
+    
+    Meant as a process pool initializer, paired with start_worker_log_listener.
+    
+    Args:
+        log_queue: A multiprocessing queue shared with the main process
+    """
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
 # Initialize logging
-logger = setup_logging()
\ No newline at end of file
+logger = setup_logging()
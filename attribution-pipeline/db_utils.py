@@ -8,11 +8,22 @@ including connecting, querying data, and writing results.
 import sqlite3
 import pandas as pd
 import logging
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Iterator
 from datetime import datetime
+from operator import itemgetter
 
 from config import logger
 
+# Number of rows fetched from SQLite per DataFrame chunk
+READ_CHUNKSIZE = 50_000
+
+# Session engagement flags only hold 0 or 1, so read them as int8 instead of int64
+SESSION_FLAG_DTYPES = {
+    'holder_engagement': 'int8',
+    'closer_engagement': 'int8',
+    'impression_interaction': 'int8'
+}
+
 def get_db_connection(db_path: str) -> sqlite3.Connection:
     """
     Create a connection to the SQLite database.
@@ -27,9 +38,17 @@ def get_db_connection(db_path: str) -> sqlite3.Connection:
         sqlite3.Error: If connection to the database fails
     """
     try:
-        conn = sqlite3.connect(db_path)
+        # Autocommit mode: writes are wrapped in explicit transactions where needed.
+        # A larger statement cache keeps the prepared form of every query the pipeline reuses.
+        conn = sqlite3.connect(db_path, isolation_level=None, cached_statements=256)
         # Enable foreign keys
         conn.execute("PRAGMA foreign_keys = ON")
+        # WAL journaling with relaxed syncing, plus a larger page cache and in-memory temp storage
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA cache_size = -65536")
+        conn.execute("PRAGMA mmap_size = 268435456")
         # Return rows as dictionaries
         conn.row_factory = sqlite3.Row
         logger.info(f"Connected to database: {db_path}")
@@ -38,6 +57,41 @@ def get_db_connection(db_path: str) -> sqlite3.Connection:
         logger.error(f"Error connecting to database: {e}")
         raise
 
+def get_read_connection(db_path: str) -> sqlite3.Connection:
+    """
+    Create a read-only connection to the SQLite database.
+    
+    With WAL journaling, read-only connections never block the writer or each other,
+    so several can query the database in parallel. Temporary tables (as used by
+    load_temp_ids) remain writable.
+    
+    Args:
+        db_path: Path to the SQLite database file
+        
+    Returns:
+        A read-only connection object to the database
+        
+    Raises:
+        sqlite3.Error: If connection to the database fails
+    """
+    try:
+        conn = sqlite3.connect(
+            f"file:{db_path}?mode=ro",
+            uri=True,
+            isolation_level=None,
+            cached_statements=256
+        )
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA cache_size = -65536")
+        conn.execute("PRAGMA mmap_size = 268435456")
+        # Return rows as dictionaries
+        conn.row_factory = sqlite3.Row
+        logger.debug(f"Opened read-only connection to database: {db_path}")
+        return conn
+    except sqlite3.Error as e:
+        logger.error(f"Error connecting to database: {e}")
+        raise
+
 def execute_sql_file(conn: sqlite3.Connection, sql_file_path: str) -> None:
     """
     Execute SQL statements from a file.
@@ -64,6 +118,59 @@ def execute_sql_file(conn: sqlite3.Connection, sql_file_path: str) -> None:
         conn.rollback()
         raise
 
+def update_statistics(conn: sqlite3.Connection) -> None:
+    """
+    Keep the query planner's table statistics up to date.
+    
+    Runs a full ANALYZE the first time (when no statistics exist yet) so the planner
+    can choose the covering indexes; afterwards PRAGMA optimize only re-analyzes
+    tables whose statistics are stale.
+    
+    Args:
+        conn: SQLite connection object
+        
+    Raises:
+        sqlite3.Error: If gathering statistics fails
+    """
+    try:
+        has_stats = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+        ).fetchone()
+        if has_stats:
+            conn.execute("PRAGMA optimize")
+        else:
+            conn.execute("ANALYZE")
+            logger.info("Analyzed database tables for the query planner")
+    except sqlite3.Error as e:
+        logger.error(f"Error updating table statistics: {e}")
+        raise
+
+def load_temp_ids(
+    conn: sqlite3.Connection,
+    table_name: str,
+    column_name: str,
+    ids: Iterable[str]
+) -> None:
+    """
+    Load identifiers into a temporary single-column table for joining.
+    
+    Joining against a temporary table keeps the query text constant regardless of
+    the number of identifiers, so it is not subject to SQLite's bound-parameter
+    limit and the query plan stays stable.
+    
+    Args:
+        conn: SQLite connection object
+        table_name: Name of the temporary table (created if it does not exist)
+        column_name: Name of the identifier column
+        ids: Identifiers to load; any previous contents of the table are replaced
+    """
+    conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table_name} ({column_name} TEXT PRIMARY KEY)")
+    conn.execute(f"DELETE FROM {table_name}")
+    conn.executemany(
+        f"INSERT OR IGNORE INTO {table_name} ({column_name}) VALUES (?)",
+        ((id_,) for id_ in ids)
+    )
+
 def get_conversions(
     conn: sqlite3.Connection, 
     start_date: Optional[str] = None, 
@@ -97,26 +204,27 @@ def get_conversions(
     
     try:
         logger.info(f"Querying conversions with date range: {start_date} to {end_date}")
-        return pd.read_sql_query(query, conn, params=params)
+        return pd.concat(
+            pd.read_sql_query(query, conn, params=params, chunksize=READ_CHUNKSIZE),
+            ignore_index=True
+        )
     except pd.io.sql.DatabaseError as e:
         logger.error(f"Error querying conversions: {e}")
         raise
 
-def get_sessions(
-    conn: sqlite3.Connection, 
+def _build_sessions_query(
     start_date: Optional[str] = None, 
     end_date: Optional[str] = None
-) -> pd.DataFrame:
+) -> Tuple[str, list]:
     """
-    Query sessions from the database, optionally filtered by date range.
+    Build the sessions query and its parameters for an optional date range.
     
     Args:
-        conn: SQLite connection object
         start_date: Optional start date filter (YYYY-MM-DD)
         end_date: Optional end date filter (YYYY-MM-DD)
         
     Returns:
-        DataFrame containing session data
+        Tuple of (query, params)
     """
     query = """
     SELECT ss.*, sc.cost 
@@ -137,49 +245,105 @@ def get_sessions(
             query += "ss.event_date <= ?"
             params.append(end_date)
     
+    return query, params
+
+def get_sessions_iter(
+    conn: sqlite3.Connection, 
+    start_date: Optional[str] = None, 
+    end_date: Optional[str] = None,
+    chunksize: int = READ_CHUNKSIZE
+) -> Iterator[pd.DataFrame]:
+    """
+    Stream sessions from the database in chunks, optionally filtered by date range.
+    
+    Only one chunk is held in memory at a time, for consumers that can process
+    sessions incrementally.
+    
+    Args:
+        conn: SQLite connection object
+        start_date: Optional start date filter (YYYY-MM-DD)
+        end_date: Optional end date filter (YYYY-MM-DD)
+        chunksize: Number of rows per chunk
+        
+    Yields:
+        DataFrames containing session data
+    """
+    query, params = _build_sessions_query(start_date, end_date)
+    
     try:
         logger.info(f"Querying sessions with date range: {start_date} to {end_date}")
-        return pd.read_sql_query(query, conn, params=params)
+        yield from pd.read_sql_query(query, conn, params=params, chunksize=chunksize, dtype=SESSION_FLAG_DTYPES)
     except pd.io.sql.DatabaseError as e:
         logger.error(f"Error querying sessions: {e}")
         raise
 
-def get_sessions_for_user(
+def get_sessions(
     conn: sqlite3.Connection, 
-    user_ids: tuple,
-    before_timestamp: Optional[str] = None
+    start_date: Optional[str] = None, 
+    end_date: Optional[str] = None
 ) -> pd.DataFrame:
     """
-    Get all sessions for multiple users.
+    Query sessions from the database, optionally filtered by date range.
     
     Args:
         conn: SQLite connection object
-        user_ids: Tuple of user identifiers
-        before_timestamp: Optional timestamp in format 'YYYY-MM-DD HH:MM:SS'
+        start_date: Optional start date filter (YYYY-MM-DD)
+        end_date: Optional end date filter (YYYY-MM-DD)
         
     Returns:
-        DataFrame containing session data for all users
+        DataFrame containing session data
     """
-    query = """
-    SELECT ss.*, sc.cost 
-    FROM session_sources ss
-    LEFT JOIN session_costs sc ON ss.session_id = sc.session_id
-    WHERE ss.user_id IN ({})
-    """.format(','.join(['?'] * len(user_ids)))
+    # Reading in chunks avoids holding every raw row tuple alongside the DataFrame
+    return pd.concat(get_sessions_iter(conn, start_date, end_date), ignore_index=True)
+
+def get_sessions_in_windows(
+    conn: sqlite3.Connection,
+    windows: Iterable[Tuple[str, Optional[str], Optional[str], str, str]]
+) -> pd.DataFrame:
+    """
+    Get the sessions of multiple users that fall inside a per-user time window.
     
-    params = list(user_ids)
+    Each window is (user_id, after_date, after_time, before_date, before_time). Sessions
+    at or after the lower bound (none when after_date is None) and strictly before the
+    upper bound are returned. The bounds are compared against the date and time columns
+    directly, so the (user_id, event_date, event_time) index serves every window as a
+    range scan and rows outside it never leave SQLite.
     
-    if before_timestamp:
-        query += " AND datetime(ss.event_date || ' ' || ss.event_time) < datetime(?)"
-        params.append(before_timestamp)
+    Args:
+        conn: SQLite connection object
+        windows: One (user_id, after_date, after_time, before_date, before_time) tuple per user
+        
+    Returns:
+        DataFrame containing the session data inside the windows
+    """
+    conn.execute("""
+    CREATE TEMP TABLE IF NOT EXISTS _session_windows (
+        user_id TEXT PRIMARY KEY,
+        after_date TEXT,
+        after_time TEXT,
+        before_date TEXT NOT NULL,
+        before_time TEXT NOT NULL
+    )
+    """)
+    conn.execute("DELETE FROM _session_windows")
+    conn.executemany("INSERT OR REPLACE INTO _session_windows VALUES (?, ?, ?, ?, ?)", windows)
     
-    query += " ORDER BY ss.event_date, ss.event_time"
+    # CROSS JOIN keeps the windows as the outer loop; the temp table has no statistics
+    # and the planner would otherwise scan session_sources by date
+    query = """
+    SELECT ss.*
+    FROM _session_windows w
+    CROSS JOIN session_sources ss ON ss.user_id = w.user_id
+    WHERE (ss.event_date < w.before_date OR (ss.event_date = w.before_date AND ss.event_time < w.before_time))
+      AND (w.after_date IS NULL OR ss.event_date > w.after_date
+           OR (ss.event_date = w.after_date AND ss.event_time >= w.after_time))
+    ORDER BY ss.event_date, ss.event_time
+    """
     
     try:
-        logger.info(f"Querying sessions for {len(user_ids)} users")
-        return pd.read_sql_query(query, conn, params=params)
+        return pd.read_sql_query(query, conn, dtype=SESSION_FLAG_DTYPES)
     except pd.io.sql.DatabaseError as e:
-        logger.error(f"Error querying sessions for users: {e}")
+        logger.error(f"Error querying sessions in windows: {e}")
         raise
 
 def insert_attribution_results(conn: sqlite3.Connection, attribution_results: list) -> None:
@@ -203,25 +367,21 @@ def insert_attribution_results(conn: sqlite3.Connection, attribution_results: li
         VALUES (?, ?, ?)
         """
         
-        # Format data according to the table structure
-        data = [
-            (
-                result['conv_id'],
-                result['session_id'],
-                result['ihc']
-            )
-            for result in attribution_results
-        ]
+        # Bind the already-parsed results directly; itemgetter builds each parameter
+        # tuple in C and executemany consumes them lazily, without an intermediate list
+        rows = map(itemgetter('conv_id', 'session_id', 'ihc'), attribution_results)
         
-        # Execute the insert
-        cursor.executemany(insert_query, data)
-        conn.commit()
+        # Execute the insert in a single transaction
+        conn.execute("BEGIN IMMEDIATE")
+        cursor.executemany(insert_query, rows)
+        conn.execute("COMMIT")
         
         # Log the number of rows actually inserted (affected)
         logging.info(f"Inserted {cursor.rowcount} attribution results")
     except Exception as e:
         logging.error(f"Error inserting attribution results: {e}")
-        conn.rollback()
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
         raise
 
 def check_attribution_sums(conn: sqlite3.Connection) -> bool:
@@ -243,12 +403,13 @@ def check_attribution_sums(conn: sqlite3.Connection) -> bool:
     
     try:
         cursor = conn.cursor()
+        cursor.row_factory = None
         result = cursor.execute(query).fetchall()
         
         if result:
             logger.warning(f"Found {len(result)} conversions with attribution sums not equal to 1.0")
-            for row in result:
-                logger.warning(f"Conversion {row['conv_id']} has attribution sum of {row['total_ihc']}")
+            for conv_id, total_ihc in result:
+                logger.warning(f"Conversion {conv_id} has attribution sum of {total_ihc}")
             return False
         else:
             logger.info("All conversions have attribution sums of 1.0")
@@ -274,22 +435,25 @@ def check_attribution_exists(
     if not conv_ids:
         return True, []
     
-    # Convert list to tuple for SQL IN clause
-    conv_ids_tuple = tuple(conv_ids)
-    
     # Query to find which conversion IDs already have attribution data
     query = """
-    SELECT DISTINCT conv_id 
-    FROM attribution_customer_journey
-    WHERE conv_id IN ({})
-    """.format(','.join(['?'] * len(conv_ids_tuple)))
+    SELECT c.conv_id
+    FROM _conv_ids c
+    WHERE EXISTS (
+        SELECT 1 FROM attribution_customer_journey a WHERE a.conv_id = c.conv_id
+    )
+    """
     
     try:
+        load_temp_ids(conn, "_conv_ids", "conv_id", conv_ids)
+        
+        # Plain tuples are cheaper than sqlite3.Row objects for this single-column scan
         cursor = conn.cursor()
-        existing_ids = [row['conv_id'] for row in cursor.execute(query, conv_ids_tuple).fetchall()]
+        cursor.row_factory = None
+        existing_ids = {row[0] for row in cursor.execute(query)}
         
         # Find missing conversion IDs
-        missing_ids = list(set(conv_ids) - set(existing_ids))
+        missing_ids = [conv_id for conv_id in conv_ids if conv_id not in existing_ids]
         
         if missing_ids:
             logger.info(f"Found {len(missing_ids)} conversions without attribution data")
@@ -7,25 +7,76 @@ formatted according to the requirements of the IHC Attribution API.
 
 import pandas as pd
 import logging
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Iterator
+import multiprocessing
 import sqlite3
-from datetime import datetime
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby, repeat
+from operator import itemgetter
 import numpy as np
-from db_utils import get_sessions_for_user
+from db_utils import get_read_connection, get_sessions_in_windows
 
-from config import logger
+from config import JOURNEY_WORKERS, init_worker_logging, logger, start_worker_log_listener
 
-def validate_timestamp(timestamp: str) -> bool:
-    """Validate timestamp format for IHC API (YYYY-MM-DD HH:MM:SS)."""
+# Number of conversions whose sessions are fetched and matched together
+JOURNEY_BATCH_SIZE = 1000
+
+# Session fields sent to the IHC API, in request order
+API_SESSION_FIELDS = [
+    'conversion_id', 'session_id', 'timestamp', 'channel_label', 'holder_engagement',
+    'closer_engagement', 'conversion', 'impression_interaction'
+]
+
+def parse_timestamps(dates: pd.Series, times: pd.Series) -> pd.Series:
+    """Combine date and time columns into nanosecond datetimes.
+    
+    Values that do not match the API format (YYYY-MM-DD HH:MM:SS) become NaT.
+    A fixed resolution keeps session and conversion timestamps comparable as
+    merge keys regardless of the resolution pandas would infer.
+    
+    Dates are parsed on their own, where the cache makes this one parse per distinct
+    day, and zero-padded HH:MM:SS times are decoded with integer arithmetic on their
+    bytes. The few rows that fail that check (e.g. an unpadded '1:00:00') are handed
+    to pandas with the full format, so they parse exactly as strptime would.
+    """
+    days = pd.to_datetime(dates, format='%Y-%m-%d', errors='coerce', cache=True).to_numpy('datetime64[ns]')
+    
     try:
-        datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
-        return True
-    except ValueError:
-        return False
+        # One row of bytes per time; a valid time fills exactly the first 8 of 9 bytes
+        raw = times.to_numpy(dtype='S9').view(np.uint8).reshape(-1, 9)
+    except UnicodeEncodeError:
+        # Non-ASCII text cannot be a valid time, so let pandas sort out which rows are
+        return pd.to_datetime(
+            dates + ' ' + times, format='%Y-%m-%d %H:%M:%S', errors='coerce', cache=True
+        ).astype('datetime64[ns]')
+    
+    digits = raw[:, [0, 1, 3, 4, 6, 7]].astype(np.int64) - ord('0')
+    hours = digits[:, 0] * 10 + digits[:, 1]
+    minutes = digits[:, 2] * 10 + digits[:, 3]
+    seconds = digits[:, 4] * 10 + digits[:, 5]
+    valid = (
+        ((digits >= 0) & (digits <= 9)).all(axis=1)
+        & (raw[:, 2] == ord(':')) & (raw[:, 5] == ord(':')) & (raw[:, 8] == 0)
+        & (hours < 24) & (minutes < 60) & (seconds < 60)
+    )
+    
+    timestamps = days + ((hours * 3600 + minutes * 60 + seconds) * 1_000_000_000).astype('timedelta64[ns]')
+    timestamps[~valid] = np.datetime64('NaT')
+    
+    # strptime also accepts times without zero padding, so only give up on a row once
+    # pandas has rejected it too
+    retry = ~valid & ~np.isnat(days)
+    if retry.any():
+        timestamps[retry] = pd.to_datetime(
+            dates[retry] + ' ' + times[retry], format='%Y-%m-%d %H:%M:%S', errors='coerce'
+        ).to_numpy('datetime64[ns]')
+    return pd.Series(timestamps, index=dates.index)
 
 def build_customer_journeys(
     conn: sqlite3.Connection,
-    conversions_df: pd.DataFrame
+    conversions_df: pd.DataFrame,
+    max_workers: int = JOURNEY_WORKERS
 ) -> List[Dict[str, Any]]:
     """
     Build customer journeys for each conversion.
@@ -33,158 +84,182 @@ def build_customer_journeys(
     For each conversion, find all sessions for the user that occurred before the conversion
     and format them according to the IHC API requirements.
     
+    Users never share sessions, so when there is more than one batch of conversions they
+    are split by user into independent groups that are built in parallel processes, each
+    reading the database through its own read-only connection.
+    
     Args:
         conn: SQLite connection object
         conversions_df: DataFrame containing conversion data
+        max_workers: Maximum number of processes used to build journeys
         
     Returns:
         List of dictionaries representing customer journey sessions
     """
-    all_journey_sessions = []
-    
-    # Track which session_ids have already been assigned to a conversion
-    assigned_session_ids = set()
+    # Parse all conversion timestamps once and skip those that do not match the API format
+    conversions_df['conv_datetime'] = parse_timestamps(conversions_df['conv_date'], conversions_df['conv_time'])
+    invalid_timestamps = conversions_df['conv_datetime'].isna()
+    for conv_id in conversions_df.loc[invalid_timestamps, 'conv_id']:
+        logger.error(f"Invalid conversion timestamp format for {conv_id}")
     
     # Sort conversions by date/time to ensure earlier conversions get priority
-    conversions_df['conv_datetime'] = pd.to_datetime(
-        conversions_df['conv_date'] + ' ' + conversions_df['conv_time']
-    )
-    conversions_df = conversions_df.sort_values('conv_datetime')
+    conversions_df = conversions_df.dropna(subset=['conv_datetime']).sort_values('conv_datetime')
+    conversions_df['conv_order'] = np.arange(len(conversions_df))
     
-    # Process conversions in batches for better performance
-    batch_size = 1000
-    for batch_start in range(0, len(conversions_df), batch_size):
-        batch_end = min(batch_start + batch_size, len(conversions_df))
-        batch_conversions = conversions_df.iloc[batch_start:batch_end]
-        
-        # Get all relevant user IDs for this batch
-        user_ids = tuple(batch_conversions['user_id'].unique())
+    db_path = _get_database_file(conn)
+    workers = min(max_workers, -(-len(conversions_df) // JOURNEY_BATCH_SIZE))
+    
+    if workers > 1 and db_path:
+        # Keep every user in a single group so session assignment stays consistent
+        groups = pd.util.hash_array(conversions_df['user_id'].to_numpy()) % workers
+        logger.info(f"Building journeys in {workers} processes")
         
+        # Workers log through the main process, which alone owns the log file
+        mp_context = multiprocessing.get_context('spawn')
+        log_queue = mp_context.Queue()
+        log_listener = start_worker_log_listener(log_queue)
         try:
-            # Get all sessions for these users in one query
-            sessions_df = get_sessions_for_user(conn, user_ids)
-            
-            if sessions_df.empty:
-                continue
-            
-            # Process each conversion in the batch
-            for _, conversion in batch_conversions.iterrows():
-                conv_id = conversion['conv_id']
-                user_id = conversion['user_id']
-                conv_timestamp = f"{conversion['conv_date']} {conversion['conv_time']}"
-                
-                if not validate_timestamp(conv_timestamp):
-                    logger.error(f"Invalid conversion timestamp format for {conv_id}")
-                    continue
-                
-                # Filter sessions for this user that occurred before the conversion
-                user_sessions = sessions_df[
-                    (sessions_df['user_id'] == user_id) & 
-                    (pd.to_datetime(sessions_df['event_date'] + ' ' + sessions_df['event_time']) < 
-                     pd.to_datetime(conv_timestamp))
-                ].copy()
-                
-                if user_sessions.empty:
-                    logger.warning(f"No sessions found for user {user_id} before conversion {conv_id}")
-                    continue
-                
-                # Filter out sessions that have already been assigned to another conversion
-                unassigned_sessions = user_sessions[
-                    ~user_sessions['session_id'].isin(assigned_session_ids)
-                ]
-                
-                if unassigned_sessions.empty:
-                    logger.warning(f"All sessions for user {user_id} have already been assigned to other conversions")
-                    continue
-                
-                # Format sessions for this conversion
-                journey_sessions = format_sessions_for_api(unassigned_sessions, conv_id, conv_timestamp)
-                
-                # Track which session_ids have been assigned
-                for session in journey_sessions:
-                    assigned_session_ids.add(session['session_id'])
-                
-                all_journey_sessions.extend(journey_sessions)
-                
-                logger.info(f"Built journey for conversion {conv_id} with {len(journey_sessions)} sessions")
-                
-        except Exception as e:
-            logger.error(f"Error processing batch: {e}")
-            raise
+            with ProcessPoolExecutor(
+                workers,
+                mp_context=mp_context,
+                initializer=init_worker_logging,
+                initargs=(log_queue,)
+            ) as executor:
+                frames = list(executor.map(
+                    _build_journey_frame_from_path,
+                    repeat(db_path),
+                    (conversions_df[groups == i] for i in range(workers))
+                ))
+        finally:
+            log_listener.stop()
+    else:
+        frames = [_build_journey_frame(conn, conversions_df)]
     
-    return all_journey_sessions
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return []
+    
+    # Restore the global conversion order; sessions within a journey are already sorted
+    journey_df = pd.concat(frames, ignore_index=True).sort_values('conv_order', kind='mergesort')
+    return journey_df[API_SESSION_FIELDS].to_dict(orient='records')
 
-def format_sessions_for_api(
-    sessions_df: pd.DataFrame, 
-    conv_id: str, 
-    conv_timestamp: str
-) -> List[Dict[str, Any]]:
-    """Format sessions according to the IHC API requirements.
+def _get_database_file(conn: sqlite3.Connection) -> str:
+    """Return the file behind the connection's main database ('' for in-memory databases)."""
+    for _, name, path in conn.execute("PRAGMA database_list").fetchall():
+        if name == 'main':
+            return path
+    return ''
+
+def _build_journey_frame_from_path(db_path: str, conversions_df: pd.DataFrame) -> pd.DataFrame:
+    """Build journeys in a worker process over its own read-only connection."""
+    conn = get_read_connection(db_path)
+    try:
+        return _build_journey_frame(conn, conversions_df)
+    finally:
+        conn.close()
+
+def _build_journey_frame(conn: sqlite3.Connection, conversions_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Build the journey sessions for conversions sorted by conv_datetime.
     
     Args:
-        sessions_df: DataFrame containing session data
-        conv_id: Conversion ID
-        conv_timestamp: Conversion timestamp
+        conn: SQLite connection object
+        conversions_df: Conversions with parsed conv_datetime and conv_order columns,
+            sorted by conv_datetime
         
     Returns:
-        List of dictionaries representing formatted sessions
+        DataFrame with the API session fields plus conv_order, with each journey's
+        sessions stored contiguously and in chronological order
     """
-    # Sort sessions chronologically
-    sessions_df = sessions_df.sort_values(by=['event_date', 'event_time'])
+    journey_frames = []
     
-    # Create a temporary column to identify the conversion session
-    sessions_df = sessions_df.copy()  # Create a copy to avoid SettingWithCopyWarning
-    sessions_df['_temp_conversion_flag'] = 0
+    # Latest conversion (date, time) per user in earlier batches; any earlier session of
+    # that user has already been assigned to one of those conversions
+    claimed_until = {}
     
-    # Find the session closest to the conversion timestamp
-    conversion_timestamp = datetime.strptime(conv_timestamp, '%Y-%m-%d %H:%M:%S')
-    
-    # Convert session timestamps to datetime for comparison
-    sessions_df['_temp_datetime'] = sessions_df.apply(
-        lambda row: datetime.strptime(f"{row['event_date']} {row['event_time']}", '%Y-%m-%d %H:%M:%S'), 
-        axis=1
-    )
-    
-    # Find the session closest to the conversion timestamp
-    if not sessions_df.empty:
-        # Get sessions before conversion
-        valid_sessions = sessions_df[sessions_df['_temp_datetime'] <= conversion_timestamp]
-        
-        if not valid_sessions.empty:
-            # Find the session closest to conversion time
-            closest_idx = valid_sessions['_temp_datetime'].idxmax()
-            sessions_df.loc[closest_idx, '_temp_conversion_flag'] = 1
-    
-    formatted_sessions = []
-    
-    for _, session in sessions_df.iterrows():
-        session_timestamp = f"{session['event_date']} {session['event_time']}"
+    # Process conversions in batches for better performance
+    for batch_start in range(0, len(conversions_df), JOURNEY_BATCH_SIZE):
+        batch_end = min(batch_start + JOURNEY_BATCH_SIZE, len(conversions_df))
+        batch_conversions = conversions_df.iloc[batch_start:batch_end]
         
-        if not validate_timestamp(session_timestamp):
-            logger.warning(f"Skipping session {session['session_id']} due to invalid timestamp")
-            continue
+        # Only sessions between a user's last conversion in earlier batches and their last
+        # conversion in this batch can be assigned here, so let SQLite filter the rest
+        last_conversions = batch_conversions.drop_duplicates('user_id', keep='last')
+        windows = [
+            (user_id, *claimed_until.get(user_id, (None, None)), conv_date, conv_time)
+            for user_id, conv_date, conv_time
+            in last_conversions[['user_id', 'conv_date', 'conv_time']].itertuples(index=False, name=None)
+        ]
         
-        # Format session for API
-        formatted_session = {
-            'conversion_id': conv_id,
-            'session_id': session['session_id'],
-            'timestamp': session_timestamp,
-            'channel_label': session['channel_name'],
-            'holder_engagement': int(session['holder_engagement']),
-            'closer_engagement': int(session['closer_engagement']),
-            'conversion': int(session['_temp_conversion_flag']),
-            'impression_interaction': int(session['impression_interaction'])
-        }
+        # Batches are in conversion order, so this batch's latest conversions supersede
+        claimed_until.update((window[0], window[3:]) for window in windows)
         
-        formatted_sessions.append(formatted_session)
+        try:
+            # Get the candidate sessions for all users of the batch in one query
+            sessions_df = get_sessions_in_windows(conn, windows)
+            
+            if sessions_df.empty:
+                continue
+            
+            sessions_df = sessions_df.assign(
+                event_dt=parse_timestamps(sessions_df['event_date'], sessions_df['event_time'])
+            )
+            
+            # Skip sessions with invalid timestamps
+            invalid_timestamps = sessions_df['event_dt'].isna()
+            for session_id in sessions_df.loc[invalid_timestamps, 'session_id']:
+                logger.warning(f"Skipping session {session_id} due to invalid timestamp")
+            
+            sessions_df = sessions_df[~invalid_timestamps]
+            
+            # Attach every session to the user's next conversion in a single pass, so
+            # each session belongs to the earliest conversion that happened after it
+            batch_keys = batch_conversions[['user_id', 'conv_id', 'conv_datetime', 'conv_order']]
+            journey_df = pd.merge_asof(
+                sessions_df.sort_values('event_dt', kind='mergesort'),
+                batch_keys,
+                left_on='event_dt',
+                right_on='conv_datetime',
+                by='user_id',
+                direction='forward',
+                allow_exact_matches=False
+            ).dropna(subset=['conv_id'])
+            
+            for conv_id in batch_conversions.loc[~batch_conversions['conv_id'].isin(journey_df['conv_id']), 'conv_id']:
+                logger.warning(f"No unassigned sessions found before conversion {conv_id}")
+            
+            if journey_df.empty:
+                continue
+            
+            # Order journeys like the conversions and sessions chronologically; the latest
+            # session of each journey is the conversion session, and of several sessions
+            # tied at the latest timestamp the first one is
+            journey_df = journey_df.sort_values(['conv_order', 'event_dt'], kind='mergesort')
+            is_latest = journey_df['event_dt'].eq(journey_df.groupby('conv_id')['event_dt'].transform('max'))
+            first_at_timestamp = ~journey_df.duplicated(['conv_id', 'event_dt'], keep='first')
+            journey_df['conversion'] = (is_latest & first_at_timestamp).astype('int8')
+            journey_df['timestamp'] = journey_df['event_date'].str.cat(journey_df['event_time'], sep=' ')
+            
+            journey_frames.append(journey_df.rename(columns={
+                'conv_id': 'conversion_id',
+                'channel_name': 'channel_label'
+            })[API_SESSION_FIELDS + ['conv_order']])
+            
+            logger.info(f"Built {journey_df['conv_id'].nunique()} journeys with {len(journey_df)} sessions")
+                
+        except Exception as e:
+            logger.error(f"Error processing batch: {e}")
+            raise
     
-    return formatted_sessions
+    if not journey_frames:
+        return pd.DataFrame(columns=API_SESSION_FIELDS + ['conv_order'])
+    return pd.concat(journey_frames, ignore_index=True)
 
 def chunk_journeys(
-    journeys: List[Dict[str, Any]], 
+    journeys: Iterable[Dict[str, Any]], 
     max_journeys_per_chunk: int = 100,
     max_sessions_per_chunk: int = 200
-) -> List[List[Dict[str, Any]]]:
+) -> Iterator[List[Dict[str, Any]]]:
     """
     Split customer journeys into chunks according to API limits.
     
@@ -192,36 +267,38 @@ def chunk_journeys(
     - Maximum number of customer journeys in a single request (100)
     - Maximum number of sessions in a single request (200 for test accounts)
     
-    This function splits the journeys into chunks that respect these limits.
+    This function splits the journeys into chunks that respect these limits. Chunks are
+    yielded as soon as they are full, so only one chunk is held at a time and the
+    journeys can themselves be a stream.
     
     Args:
-        journeys: List of dictionaries representing customer journey sessions
+        journeys: Iterable of dictionaries representing customer journey sessions, with the
+            sessions of each conversion stored contiguously (as build_customer_journeys
+            returns them)
         max_journeys_per_chunk: Maximum number of journeys per chunk
         max_sessions_per_chunk: Maximum number of sessions per chunk
         
-    Returns:
-        List of chunks, where each chunk is a list of journey sessions
+    Yields:
+        Chunks, where each chunk is a list of journey sessions
     """
-    # Group sessions by conversion_id
-    journey_groups = {}
-    for session in journeys:
-        conv_id = session['conversion_id']
-        if conv_id not in journey_groups:
-            journey_groups[conv_id] = []
-        journey_groups[conv_id].append(session)
-    
     # Create chunks
-    chunks = []
+    total_chunks = 0
     current_chunk = []
     current_chunk_journeys = 0
     current_chunk_sessions = 0
+    total_journeys = 0
     
-    for conv_id, sessions in journey_groups.items():
+    # Stream the journeys group by group instead of building a dict of lists first
+    for conv_id, group in groupby(journeys, key=itemgetter('conversion_id')):
+        sessions = list(group)
+        total_journeys += 1
+        
         # If adding this journey would exceed limits, start a new chunk
         if (current_chunk_journeys >= max_journeys_per_chunk or 
             current_chunk_sessions + len(sessions) > max_sessions_per_chunk):
             if current_chunk:
-                chunks.append(current_chunk)
+                yield current_chunk
+                total_chunks += 1
             current_chunk = []
             current_chunk_journeys = 0
             current_chunk_sessions = 0
@@ -233,10 +310,10 @@ def chunk_journeys(
     
     # Add the last chunk if it's not empty
     if current_chunk:
-        chunks.append(current_chunk)
+        yield current_chunk
+        total_chunks += 1
     
-    logger.info(f"Split {len(journey_groups)} journeys into {len(chunks)} chunks")
-    return chunks
+    logger.info(f"Split {total_journeys} journeys into {total_chunks} chunks")
 
 def validate_journey_data(journeys: List[Dict[str, Any]]) -> bool:
     """
@@ -258,40 +335,45 @@ def validate_journey_data(journeys: List[Dict[str, Any]]) -> bool:
         'holder_engagement', 'closer_engagement', 'conversion'
     ]
     
-    for i, session in enumerate(journeys):
-        # Check required fields
-        for field in required_fields:
-            if field not in session:
-                logger.error(f"Session {i} missing required field: {field}")
-                return False
-        
-        # Check field types
-        if not isinstance(session['conversion_id'], str):
-            logger.error(f"Session {i}: conversion_id must be a string")
-            return False
-        if not isinstance(session['session_id'], str):
-            logger.error(f"Session {i}: session_id must be a string")
-            return False
-        if not isinstance(session['timestamp'], str):
-            logger.error(f"Session {i}: timestamp must be a string")
+    if not journeys:
+        return True
+    
+    # Build one frame so every check is a single vectorized pass over a column
+    journeys_df = pd.DataFrame(journeys)
+    
+    # Check required fields
+    for field in required_fields:
+        missing = journeys_df[field].isna() if field in journeys_df.columns else None
+        if missing is None or missing.any():
+            i = 0 if missing is None else int(missing.to_numpy().argmax())
+            logger.error(f"Session {i} missing required field: {field}")
             return False
-        if not isinstance(session['channel_label'], str):
-            logger.error(f"Session {i}: channel_label must be a string")
+    
+    # Check field types
+    for field in ['conversion_id', 'session_id', 'timestamp', 'channel_label']:
+        if pd.api.types.infer_dtype(journeys_df[field], skipna=False) != 'string':
+            i = int(journeys_df[field].map(type).ne(str).to_numpy().argmax())
+            logger.error(f"Session {i}: {field} must be a string")
             return False
-        
-        # Check engagement flags
-        for flag in ['holder_engagement', 'closer_engagement', 'conversion', 'impression_interaction']:
-            if flag in session and session[flag] not in [0, 1]:
-                logger.error(f"Session {i}: {flag} must be 0 or 1")
-                return False
+    
+    # Check engagement flags of all sessions in one pass over a single NumPy block
+    flag_columns = [
+        flag for flag in ['holder_engagement', 'closer_engagement', 'conversion', 'impression_interaction']
+        if flag in journeys_df.columns
+    ]
+    flags = journeys_df[flag_columns].to_numpy()
+    valid = (flags == 0) | (flags == 1) | pd.isna(flags)
+    if not valid.all():
+        i, j = np.argwhere(~valid)[0]
+        logger.error(f"Session {i}: {flag_columns[j]} must be 0 or 1")
+        return False
     
     # Check if there's at least one conversion session per journey
-    conversion_ids = set(session['conversion_id'] for session in journeys)
-    for conv_id in conversion_ids:
-        conv_sessions = [s for s in journeys if s['conversion_id'] == conv_id]
-        if not any(s['conversion'] == 1 for s in conv_sessions):
-            logger.error(f"Journey {conv_id} has no conversion session")
-            return False
+    has_conversion = journeys_df.groupby('conversion_id', sort=False)['conversion'].max().eq(1)
+    if not has_conversion.all():
+        missing = has_conversion.index[~has_conversion.to_numpy()].tolist()
+        logger.error(f"{len(missing)} journeys have no conversion session: {missing}")
+        return False
     
     return True
 
@@ -305,14 +387,7 @@ def get_conversion_counts(journeys: List[Dict[str, Any]]) -> Dict[str, int]:
     Returns:
         Dictionary mapping conversion_id to session count
     """
-    counts = {}
-    for session in journeys:
-        conv_id = session['conversion_id']
-        if conv_id not in counts:
-            counts[conv_id] = 0
-        counts[conv_id] += 1
-    
-    return counts
+    return Counter(map(itemgetter('conversion_id'), journeys))
 
 def get_journey_statistics(journeys: List[Dict[str, Any]]) -> Dict[str, Any]:
     """
@@ -9,15 +9,16 @@ import argparse
 import logging
 import os
 import sys
-from datetime import datetime
-from typing import Optional, Tuple
+from datetime import date
+from itertools import chain
+from typing import Iterable, Optional, Tuple
 
 # Import utility modules
 import db_utils
 import journey_builder
 import api_utils
 import reporting
-from config import DB_PATH, REPORT_OUTPUT_PATH, logger
+from config import DB_PATH, REPORT_OUTPUT_PATH, API_MAX_CONCURRENCY, API_REQUESTS_PER_SECOND, JOURNEY_WORKERS, logger
 
 
 def parse_arguments() -> argparse.Namespace:
@@ -62,14 +63,42 @@ def parse_arguments() -> argparse.Namespace:
         help="Path where the final report will be saved"
     )
     
+    parser.add_argument(
+        "--requests_per_second",
+        type=float,
+        default=API_REQUESTS_PER_SECOND,
+        help="Maximum sustained API request rate (0 disables the limit)"
+    )
+    
     parser.add_argument(
         "--rate_limit_delay",
         type=float,
-        default=1.0,
-        help="Delay between API requests in seconds"
+        help="Deprecated: delay between API requests in seconds, use --requests_per_second "
+             "instead (sets it to 1 / delay)"
     )
     
-    return parser.parse_args()
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=API_MAX_CONCURRENCY,
+        help="Maximum number of concurrent API requests"
+    )
+    
+    parser.add_argument(
+        "--journey_workers",
+        type=int,
+        default=JOURNEY_WORKERS,
+        help="Maximum number of processes used to build customer journeys"
+    )
+    
+    args = parser.parse_args()
+    
+    # Map the old fixed delay onto the equivalent sustained request rate
+    if args.rate_limit_delay is not None:
+        logger.warning("--rate_limit_delay is deprecated, use --requests_per_second instead")
+        args.requests_per_second = 1 / args.rate_limit_delay if args.rate_limit_delay > 0 else 0
+    
+    return args
 
 def validate_dates(start_date: Optional[str], end_date: Optional[str]) -> bool:
     """
@@ -82,12 +111,12 @@ def validate_dates(start_date: Optional[str], end_date: Optional[str]) -> bool:
     Returns:
         True if dates are valid, False otherwise
     """
-    date_format = "%Y-%m-%d"
+    start_dt = end_dt = None
     
     # Validate start_date
     if start_date:
         try:
-            start_dt = datetime.strptime(start_date, date_format)
+            start_dt = _parse_date(start_date)
         except ValueError:
             logger.error(f"Invalid start_date format: {start_date}. Expected YYYY-MM-DD")
             return False
@@ -95,22 +124,25 @@ def validate_dates(start_date: Optional[str], end_date: Optional[str]) -> bool:
     # Validate end_date
     if end_date:
         try:
-            end_dt = datetime.strptime(end_date, date_format)
+            end_dt = _parse_date(end_date)
         except ValueError:
             logger.error(f"Invalid end_date format: {end_date}. Expected YYYY-MM-DD")
             return False
     
-    # Validate date range
-    if start_date and end_date:
-        start_dt = datetime.strptime(start_date, date_format)
-        end_dt = datetime.strptime(end_date, date_format)
-        
-        if start_dt > end_dt:
-            logger.error(f"start_date ({start_date}) is after end_date ({end_date})")
-            return False
+    # Validate date range using the dates parsed above
+    if start_dt and end_dt and start_dt > end_dt:
+        logger.error(f"start_date ({start_date}) is after end_date ({end_date})")
+        return False
     
     return True
 
+def _parse_date(value: str) -> date:
+    """Parse a YYYY-MM-DD date, rejecting the other ISO 8601 forms fromisoformat accepts."""
+    parsed = date.fromisoformat(value)
+    if parsed.isoformat() != value:
+        raise ValueError(f"Not a YYYY-MM-DD date: {value}")
+    return parsed
+
 def setup_database(db_path: str, sql_file: str) -> Optional[db_utils.sqlite3.Connection]:
     """
     Set up the database connection and create required tables.
@@ -126,8 +158,9 @@ def setup_database(db_path: str, sql_file: str) -> Optional[db_utils.sqlite3.Con
         # Connect to the database
         conn = db_utils.get_db_connection(db_path)
         
-        # Create required tables
+        # Create required tables and indexes
         db_utils.execute_sql_file(conn, sql_file)
+        db_utils.update_statistics(conn)
         
         return conn
     except Exception as e:
@@ -137,7 +170,8 @@ def setup_database(db_path: str, sql_file: str) -> Optional[db_utils.sqlite3.Con
 def process_conversions(
     conn: db_utils.sqlite3.Connection,
     start_date: Optional[str],
-    end_date: Optional[str]
+    end_date: Optional[str],
+    journey_workers: int = JOURNEY_WORKERS
 ) -> Tuple[bool, list, list]:
     """
     Process conversions and build customer journeys.
@@ -146,9 +180,10 @@ def process_conversions(
         conn: SQLite connection object
         start_date: Optional start date filter (YYYY-MM-DD)
         end_date: Optional end date filter (YYYY-MM-DD)
+        journey_workers: Maximum number of processes used to build journeys
         
     Returns:
-        Tuple of (success_flag, journey_chunks, conv_ids)
+        Tuple of (success_flag, journeys, conv_ids)
     """
     try:
         # Get conversions
@@ -163,7 +198,7 @@ def process_conversions(
         
         # Build customer journeys
         logger.info("Building customer journeys")
-        journeys = journey_builder.build_customer_journeys(conn, conversions_df)
+        journeys = journey_builder.build_customer_journeys(conn, conversions_df, journey_workers)
         
         if not journeys:
             logger.warning("No journeys could be built")
@@ -178,29 +213,26 @@ def process_conversions(
             logger.error("Journey validation failed")
             return False, [], []
         
-        # Chunk journeys for API
-        logger.info("Chunking journeys for API")
-        journey_chunks = journey_builder.chunk_journeys(journeys)
-        logger.info(f"Created {len(journey_chunks)} journey chunks")
-        
         # Get conversion IDs
         conv_ids = conversions_df['conv_id'].tolist()
         
-        return True, journey_chunks, conv_ids
+        return True, journeys, conv_ids
     except Exception as e:
         logger.error(f"Error processing conversions: {e}")
         return False, [], []
 
 def process_attribution(
-    journey_chunks: list,
-    rate_limit_delay: float
+    journey_chunks: Iterable[list],
+    requests_per_second: float = API_REQUESTS_PER_SECOND,
+    max_concurrency: int = API_MAX_CONCURRENCY
 ) -> Tuple[bool, list]:
     """
     Process attribution by sending journeys to the API.
     
     Args:
-        journey_chunks: List of journey chunks
-        rate_limit_delay: Delay between API requests in seconds
+        journey_chunks: Journey chunks (a list or a lazily built iterable)
+        requests_per_second: Maximum sustained API request rate
+        max_concurrency: Maximum number of concurrent API requests
         
     Returns:
         Tuple of (success_flag, attribution_results)
@@ -216,15 +248,19 @@ def process_attribution(
         
         # Initialize API client
         logger.info("Initializing API client")
-        api_client = api_utils.IHCApiClient(api_key, conv_type_id)
-        
-        # Send journeys to API
-        logger.info("Sending journeys to API")
-        attribution_results = api_utils.send_journeys_to_api(
-            api_client,
-            journey_chunks,
-            rate_limit_delay
-        )
+        with api_utils.IHCApiClient(
+            api_key,
+            conv_type_id,
+            max_concurrency=max_concurrency,
+            requests_per_second=requests_per_second
+        ) as api_client:
+            # Send journeys to API
+            logger.info("Sending journeys to API")
+            attribution_results = api_utils.send_journeys_to_api(
+                api_client,
+                journey_chunks,
+                max_concurrency=max_concurrency
+            )
         
         if not attribution_results:
             logger.warning("No attribution results returned from API")
@@ -279,14 +315,16 @@ def store_results_and_report(
         
         # Export channel reporting with metrics - pass date parameters
         logger.info("Exporting channel reporting with metrics")
-        df = reporting.export_channel_reporting_with_metrics(
+        # Only the file is needed here, so stream it without building a DataFrame
+        row_count = reporting.export_channel_reporting_with_metrics(
             conn, 
             output_path,
             start_date,
-            end_date
+            end_date,
+            return_df=False
         )
         
-        if df.empty:
+        if not row_count:
             logger.warning("No data in final report")
             return False
         
@@ -320,7 +358,9 @@ def run_pipeline(args: argparse.Namespace) -> bool:
     
     try:
         # Process conversions and build journeys
-        success, journey_chunks, conv_ids = process_conversions(conn, args.start_date, args.end_date)
+        success, journeys, conv_ids = process_conversions(
+            conn, args.start_date, args.end_date, args.journey_workers
+        )
         if not success:
             logger.error("Conversion processing failed")
             return False
@@ -335,22 +375,26 @@ def run_pipeline(args: argparse.Namespace) -> bool:
         else:
             logger.info(f"Found {len(missing_conv_ids)} conversions without attribution data")
             
-            # Filter journey chunks to only include missing conversions
-            filtered_journey_chunks = []
-            for chunk in journey_chunks:
-                filtered_chunk = [
-                    session for session in chunk 
-                    if session['conversion_id'] in missing_conv_ids
-                ]
-                if filtered_chunk:  # Only add non-empty chunks
-                    filtered_journey_chunks.append(filtered_chunk)
+            # Only include missing conversions and chunk them lazily for the API, so
+            # chunks are built as the API workers take them
+            missing_conv_ids = set(missing_conv_ids)
+            logger.info("Chunking journeys for API")
+            journey_chunks = journey_builder.chunk_journeys(
+                session for session in journeys
+                if session['conversion_id'] in missing_conv_ids
+            )
+            first_chunk = next(journey_chunks, None)
             
-            if not filtered_journey_chunks:
+            if first_chunk is None:
                 logger.warning("No journeys to process after filtering")
             else:
                 # Process attribution only for missing conversions
-                logger.info(f"Sending {len(filtered_journey_chunks)} filtered chunks to API")
-                success, attribution_results = process_attribution(filtered_journey_chunks, args.rate_limit_delay)
+                logger.info("Sending filtered journey chunks to API")
+                success, attribution_results = process_attribution(
+                    chain([first_chunk], journey_chunks),
+                    args.requests_per_second,
+                    args.max_concurrency
+                )
                 if not success:
                     logger.error("Attribution processing failed")
                     return False
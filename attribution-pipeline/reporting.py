@@ -5,13 +5,46 @@ This module provides functions for creating and exporting the final reporting ta
 with marketing performance metrics like CPO and ROAS.
 """
 
+import csv
 import pandas as pd
 import sqlite3
-from typing import Optional
+from datetime import date, timedelta
+from itertools import chain
+from typing import List, Optional, Tuple, Union
 import os
 
 from config import logger
 
+# Number of report rows fetched from SQLite and written to the CSV at a time
+EXPORT_CHUNKSIZE = 50_000
+
+# Explicit reporting ranges longer than this many days are refreshed month by month
+REPORT_SLICE_DAYS = 31
+
+def _month_slices(start_date: str, end_date: str) -> List[Tuple[str, str]]:
+    """
+    Split an inclusive YYYY-MM-DD date range into calendar-month ranges.
+    
+    Ranges of up to REPORT_SLICE_DAYS days are returned as a single slice.
+    
+    Args:
+        start_date: First date of the range (YYYY-MM-DD)
+        end_date: Last date of the range (YYYY-MM-DD)
+        
+    Returns:
+        List of (slice_start, slice_end) pairs covering the range in order
+    """
+    start, end = date.fromisoformat(start_date), date.fromisoformat(end_date)
+    if (end - start).days <= REPORT_SLICE_DAYS:
+        return [(start_date, end_date)]
+    
+    slices = []
+    while start <= end:
+        next_month = (start.replace(day=1) + timedelta(days=32)).replace(day=1)
+        slices.append((start.isoformat(), min(end, next_month - timedelta(days=1)).isoformat()))
+        start = next_month
+    return slices
+
 def create_channel_reporting(
     conn: sqlite3.Connection,
     start_date: Optional[str] = None,
@@ -21,7 +54,13 @@ def create_channel_reporting(
     Create or update the channel_reporting table with attribution data.
     
     This function joins data from session_sources, session_costs, attribution_customer_journey,
-    and conversions tables to create a comprehensive reporting table.
+    and conversions tables to create a comprehensive reporting table. Rows in the date range
+    are upserted on (channel_name, date); rows outside it are left untouched.
+    
+    Without a date range the table is refreshed incrementally, like a materialized view:
+    cr_metadata records the last attribution_customer_journey rowid that was reported,
+    and only the dates of sessions attributed after it are recomputed. Deleting the
+    'last_acj_rowid' key forces a full refresh on the next run.
     
     Args:
         conn: SQLite connection object
@@ -32,24 +71,9 @@ def create_channel_reporting(
         sqlite3.Error: If database operations fail
     """
     try:
-        # First, clear existing data if date filters are provided
-        if start_date or end_date:
-            clear_query = "DELETE FROM channel_reporting"
-            if start_date:
-                clear_query += f" WHERE date >= '{start_date}'"
-                if end_date:
-                    clear_query += f" AND date <= '{end_date}'"
-            elif end_date:
-                clear_query += f" WHERE date <= '{end_date}'"
-            
-            conn.execute(clear_query)
-            logger.info(f"Cleared channel_reporting data for date range: {start_date or 'all'} to {end_date or 'all'}")
-        else:
-            # If no date filters, clear all data
-            conn.execute("DELETE FROM channel_reporting")
-            logger.info("Cleared all channel_reporting data")
-        
-        # Build the insert query with date filters if provided
+        # Upsert the aggregates keyed on the (channel_name, date) primary key instead of
+        # deleting and re-inserting the window: attribution rows are only ever added, so
+        # a reported (channel, date) never disappears and only changed rows are rewritten
         insert_query = """
         INSERT INTO channel_reporting (
             channel_name, 
@@ -74,12 +98,51 @@ def create_channel_reporting(
             conversions c ON acj.conv_id = c.conv_id
         """
         
-        # Add date filters if provided
+        # Add date filters if provided, always as bound parameters
         where_clauses = []
+        params = []
         if start_date:
-            where_clauses.append(f"ss.event_date >= '{start_date}'")
+            where_clauses.append("ss.event_date >= ?")
+            params.append(start_date)
         if end_date:
-            where_clauses.append(f"ss.event_date <= '{end_date}'")
+            where_clauses.append("ss.event_date <= ?")
+            params.append(end_date)
+        incremental = not where_clauses
+        
+        # Wide explicit ranges are upserted one calendar month at a time so each slice's join
+        # and aggregation stay small; the slices cover disjoint dates. They are split before
+        # taking the write lock, so a malformed date cannot leave the lock held
+        if start_date and end_date:
+            param_sets = [list(bounds) for bounds in _month_slices(start_date, end_date)]
+        else:
+            param_sets = [params]
+        
+        # The whole refresh is one write transaction, taken up front, so a failure never
+        # leaves part of the range (or a watermark without its data) committed
+        conn.execute("BEGIN IMMEDIATE")
+        
+        if incremental:
+            # A date watermark would miss new attributions of sessions from earlier dates, so
+            # track the attribution rows themselves (they are only ever appended)
+            row = conn.execute("SELECT value FROM cr_metadata WHERE key = 'last_acj_rowid'").fetchone()
+            last_rowid = int(row[0]) if row else None
+            max_rowid = conn.execute(
+                "SELECT COALESCE(MAX(rowid), 0) FROM attribution_customer_journey"
+            ).fetchone()[0]
+            
+            if last_rowid is not None and last_rowid >= max_rowid:
+                conn.execute("COMMIT")
+                logger.info("channel_reporting is up to date, no new attribution results")
+                return
+            
+            if last_rowid is not None:
+                where_clauses.append("""ss.event_date IN (
+                    SELECT ss_new.event_date
+                    FROM attribution_customer_journey acj_new
+                    JOIN session_sources ss_new ON ss_new.session_id = acj_new.session_id
+                    WHERE acj_new.rowid > ?
+                )""")
+                params.append(last_rowid)
         
         if where_clauses:
             insert_query += " WHERE " + " AND ".join(where_clauses)
@@ -87,103 +150,179 @@ def create_channel_reporting(
         # Group by channel and date
         insert_query += " GROUP BY ss.channel_name, ss.event_date"
         
-        # Execute the query
-        conn.execute(insert_query)
-        conn.commit()
+        # Only touch rows whose aggregates actually changed
+        insert_query += """
+        ON CONFLICT(channel_name, date) DO UPDATE SET
+            cost = excluded.cost,
+            ihc = excluded.ihc,
+            ihc_revenue = excluded.ihc_revenue
+        WHERE cost IS NOT excluded.cost
+            OR ihc IS NOT excluded.ihc
+            OR ihc_revenue IS NOT excluded.ihc_revenue
+        """
+        
+        # rowcount counts the inserted plus the actually updated rows
+        changed_rows = 0
+        for slice_params in param_sets:
+            changed_rows += conn.execute(insert_query, slice_params).rowcount
+        if incremental:
+            conn.execute(
+                "INSERT OR REPLACE INTO cr_metadata (key, value) VALUES ('last_acj_rowid', ?)",
+                (str(max_rowid),)
+            )
+        conn.execute("COMMIT")
         
-        # Get row count for logging
-        count_query = "SELECT COUNT(*) FROM channel_reporting"
-        row_count = conn.execute(count_query).fetchone()[0]
+        if incremental:
+            refreshed = "all dates" if last_rowid is None else f"dates with attribution results after row {last_rowid}"
+            logger.info(f"Upserted channel_reporting data for {refreshed}")
+        else:
+            logger.info(
+                f"Upserted channel_reporting data for date range: {start_date or 'all'} to {end_date or 'all'}"
+                + (f" in {len(param_sets)} monthly slices" if len(param_sets) > 1 else "")
+            )
         
-        logger.info(f"Created channel_reporting table with {row_count} rows")
+        logger.info(f"Inserted or updated {changed_rows} channel_reporting rows")
         
-    except sqlite3.Error as e:
+    except Exception as e:
         logger.error(f"Error creating channel_reporting table: {e}")
-        conn.rollback()
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
         raise
 
 def export_channel_reporting_with_metrics(
     conn: sqlite3.Connection,
     output_path: str = "channel_reporting.csv",
     start_date: Optional[str] = None,
-    end_date: Optional[str] = None
-) -> pd.DataFrame:
+    end_date: Optional[str] = None,
+    return_df: bool = True
+) -> Union[pd.DataFrame, int]:
     """
     Export the channel_reporting table to a CSV file with CPO and ROAS metrics.
     
     This function:
-    1. Retrieves data from the channel_reporting table
-    2. Calculates CPO and ROAS metrics
-    3. Exports the results to a CSV file
+    1. Retrieves data from the channel_reporting table with CPO and ROAS computed in SQL
+    2. Exports the results to a CSV file, or to a zstd-compressed Parquet file when
+       output_path ends in '.parquet' (requires pyarrow or fastparquet)
+    
+    With return_df=False a CSV report is streamed from the cursor with the csv module,
+    without building any DataFrame, and only the number of exported rows is returned.
     
     Args:
         conn: SQLite connection object
-        output_path: Path where the CSV file will be saved
+        output_path: Path where the CSV (or Parquet) file will be saved
         start_date: Optional start date filter (YYYY-MM-DD)
         end_date: Optional end date filter (YYYY-MM-DD)
+        return_df: Whether to return the exported data as a DataFrame
         
     Returns:
-        DataFrame containing the channel reporting data with metrics
+        DataFrame containing the channel reporting data with metrics, or the number
+        of exported rows if return_df is False
         
     Raises:
         pd.io.sql.DatabaseError: If query fails
+        sqlite3.Error: If the streamed query fails
     """
     try:
-        # Query the base data with date filters
-        query = "SELECT * FROM channel_reporting"
+        # Query the base data with date filters; SQLite computes CPO (cost / ihc) and
+        # ROAS (ihc_revenue / cost) and returns NULL where the divisor is zero
+        query = """
+        SELECT
+            channel_name,
+            date,
+            cost,
+            ihc,
+            ihc_revenue,
+            CASE WHEN ihc <> 0 THEN cost / ihc END AS CPO,
+            CASE WHEN cost <> 0 THEN ihc_revenue / cost END AS ROAS
+        FROM channel_reporting
+        """
         
-        # Add date filters if provided
+        # Add date filters if provided, always as bound parameters
         where_clauses = []
+        params = []
         if start_date:
-            where_clauses.append(f"date >= '{start_date}'")
+            where_clauses.append("date >= ?")
+            params.append(start_date)
         if end_date:
-            where_clauses.append(f"date <= '{end_date}'")
+            where_clauses.append("date <= ?")
+            params.append(end_date)
         
-        if where_clauses:
-            query += " WHERE " + " AND ".join(where_clauses)
+        where_sql = " WHERE " + " AND ".join(where_clauses) if where_clauses else ""
         
         # Order by channel and date for better readability
-        query += " ORDER BY channel_name, date"
+        query += where_sql + " ORDER BY channel_name, date"
         
-        df = pd.read_sql_query(query, conn)
+        stream_rows = not return_df and not output_path.endswith('.parquet')
+        if stream_rows:
+            # Plain tuples straight from SQLite, no sqlite3.Row or pandas objects
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            cursor.execute(query, params)
+            first_rows = cursor.fetchmany(EXPORT_CHUNKSIZE)
+            is_empty = not first_rows
+        else:
+            chunks = pd.read_sql_query(query, conn, params=params, chunksize=EXPORT_CHUNKSIZE)
+            first_chunk = next(chunks, None)
+            is_empty = first_chunk is None or first_chunk.empty
         
-        if df.empty:
+        if is_empty:
             logger.warning(f"No data found in channel_reporting table for date range: {start_date or 'all'} to {end_date or 'all'}")
-            return df
-        
-        # Calculate CPO (Cost Per Order) = cost / ihc
-        df['CPO'] = df['cost'] / df['ihc']
-        
-        # Calculate ROAS (Return On Ad Spend) = ihc_revenue / cost
-        df['ROAS'] = df['ihc_revenue'] / df['cost']
-        
-        # Handle division by zero
-        df.replace([float('inf'), -float('inf')], float('nan'), inplace=True)
+            if not return_df:
+                return 0
+            return pd.DataFrame() if first_chunk is None else first_chunk
         
         # Create directory if it doesn't exist
-        os.makedirs(os.path.dirname(output_path) if os.path.dirname(output_path) else '.', exist_ok=True)
+        output_dir = os.path.dirname(output_path) or '.'
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
         
-        # Export to CSV
-        df.to_csv(output_path, index=False)
+        if stream_rows:
+            # Same layout as pandas' to_csv: header row, minimal quoting, empty NULLs
+            row_count = 0
+            with open(output_path, 'w', newline='') as f:
+                writer = csv.writer(f, lineterminator=os.linesep)
+                writer.writerow([column[0] for column in cursor.description])
+                rows = first_rows
+                while rows:
+                    writer.writerows(rows)
+                    row_count += len(rows)
+                    rows = cursor.fetchmany(EXPORT_CHUNKSIZE)
+            result = row_count
+        elif output_path.endswith('.parquet'):
+            # Typed, compressed columnar output; pandas needs pyarrow (or fastparquet) for it
+            df = pd.concat(chain([first_chunk], chunks), ignore_index=True)
+            try:
+                df.to_parquet(output_path, index=False, compression='zstd')
+            except ImportError as e:
+                logger.error(f"Parquet export requires pyarrow or fastparquet: {e}")
+                raise
+            result = df if return_df else len(df)
+        else:
+            # Export to CSV chunk by chunk
+            frames = []
+            with open(output_path, 'w', newline='') as f:
+                for i, chunk in enumerate(chain([first_chunk], chunks)):
+                    chunk.to_csv(f, index=False, header=(i == 0))
+                    frames.append(chunk)
+            result = pd.concat(frames, ignore_index=True)
         logger.info(f"Exported channel reporting with CPO and ROAS metrics to {output_path}")
         
-        # Log summary statistics
-        logger.info(f"Total cost: {df['cost'].sum():.2f}")
-        logger.info(f"Total revenue: {df['ihc_revenue'].sum():.2f}")
+        # Log summary statistics, aggregated by SQLite over the same rows
+        total_cost, total_revenue = conn.execute(
+            "SELECT COALESCE(SUM(cost), 0), COALESCE(SUM(ihc_revenue), 0) FROM channel_reporting" + where_sql,
+            params
+        ).fetchone()
+        logger.info(f"Total cost: {total_cost:.2f}")
+        logger.info(f"Total revenue: {total_revenue:.2f}")
         
         # Avoid division by zero in overall ROAS calculation
-        total_cost = df['cost'].sum()
         if total_cost > 0:
-            logger.info(f"Overall ROAS: {df['ihc_revenue'].sum() / total_cost:.2f}")
+            logger.info(f"Overall ROAS: {total_revenue / total_cost:.2f}")
         else:
             logger.info("Overall ROAS: N/A (total cost is zero)")
         
-        return df
+        return result
         
-    except pd.io.sql.DatabaseError as e:
+    except (pd.io.sql.DatabaseError, sqlite3.Error) as e:
         logger.error(f"Error calculating performance metrics: {e}")
         raise
-    except ZeroDivisionError as e:
-        logger.error(f"Division by zero encountered when calculating metrics: {e}")
-        # Continue with NaN values
-        return df
@@ -0,0 +1,44 @@
+"""
+Small hand-built databases for the attribution pipeline tests.
+
+The tests import the pipeline modules from the parent directory, the same way
+main.py does when it is run from attribution-pipeline/.
+"""
+
+import os
+import sys
+
+# Keep the test output to warnings and errors unless asked otherwise
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+PIPELINE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PIPELINE_DIR not in sys.path:
+    sys.path.insert(0, PIPELINE_DIR)
+
+import db_utils
+
+SQL_FILE = os.path.join(PIPELINE_DIR, 'challenge_db_create.sql')
+
+def make_connection(conversions=(), sessions=(), costs=(), db_path=':memory:'):
+    """
+    Create a pipeline database with the given rows.
+
+    Args:
+        conversions: (conv_id, user_id, conv_date, conv_time, revenue) tuples
+        sessions: (session_id, user_id, event_date, event_time, channel_name) tuples;
+            the engagement flags are derived from the position of the row
+        costs: (session_id, cost) tuples
+        db_path: Database file, in memory by default
+
+    Returns:
+        A connection created by db_utils.get_db_connection with the schema applied
+    """
+    conn = db_utils.get_db_connection(db_path)
+    db_utils.execute_sql_file(conn, SQL_FILE)
+    conn.executemany("INSERT INTO conversions VALUES (?, ?, ?, ?, ?)", conversions)
+    conn.executemany(
+        "INSERT INTO session_sources VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [(*session, i % 2, (i + 1) % 2, i % 3 == 0) for i, session in enumerate(sessions)]
+    )
+    conn.executemany("INSERT INTO session_costs VALUES (?, ?)", costs)
+    return conn
@@ -0,0 +1,149 @@
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import fixture_db  # noqa: F401 (puts the pipeline modules on sys.path)
+
+import orjson
+
+import api_utils
+
+def _journey(conv_id, session_id='s1'):
+    return [{
+        'conversion_id': conv_id,
+        'session_id': session_id,
+        'timestamp': '2023-01-01 10:00:00',
+        'channel_label': 'Direct',
+        'holder_engagement': 0,
+        'closer_engagement': 1,
+        'conversion': 1,
+        'impression_interaction': 0
+    }]
+
+class FakeResponse:
+    """Just enough of requests.Response for IHCApiClient.compute_ihc."""
+
+    def __init__(self, body, status_code=200):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = orjson.dumps(body)
+
+    def raise_for_status(self):
+        pass
+
+class FakeApi:
+    """Stub for session.post that answers like the IHC API and counts requests in flight."""
+
+    def __init__(self, latency=0.0, failing_conv_ids=()):
+        self.latency = latency
+        self.failing_conv_ids = set(failing_conv_ids)
+        self.calls = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._lock = threading.Lock()
+
+    def post(self, url, data, timeout):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency)
+            journeys = orjson.loads(data)['customer_journeys']
+            if {j['conversion_id'] for j in journeys} & self.failing_conv_ids:
+                return FakeResponse({'statusCode': 500, 'message': 'Internal error'})
+            return FakeResponse({
+                'statusCode': 200,
+                'value': [
+                    {'conversion_id': j['conversion_id'], 'session_id': j['session_id'], 'ihc': 1.0}
+                    for j in journeys
+                ]
+            })
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+def _client(api, max_concurrency=2, cache_dir=None):
+    client = api_utils.IHCApiClient(
+        'key', 'conv_type', max_concurrency=max_concurrency, requests_per_second=0, cache_dir=cache_dir
+    )
+    client.session.post = api.post
+    return client
+
+class SendJourneysToApiTest(unittest.TestCase):
+    def test_requests_in_flight_stay_within_max_concurrency(self):
+        api = FakeApi(latency=0.05)
+        chunks = [_journey(f'c{i}') for i in range(8)]
+
+        with _client(api, max_concurrency=2) as client:
+            results = api_utils.send_journeys_to_api(client, chunks, max_concurrency=2)
+
+        self.assertEqual(api.calls, 8)
+        self.assertLessEqual(api.peak_in_flight, 2)
+        self.assertEqual(sorted(r['conv_id'] for r in results), sorted(f'c{i}' for i in range(8)))
+
+    def test_invalid_and_failed_chunks_are_skipped(self):
+        api = FakeApi(failing_conv_ids={'c2'})
+        invalid_chunk = _journey('c1')
+        invalid_chunk[0]['closer_engagement'] = 2
+        chunks = [_journey('c0'), invalid_chunk, _journey('c2'), _journey('c3')]
+
+        with _client(api) as client:
+            results = api_utils.send_journeys_to_api(client, chunks)
+
+        # The invalid chunk is never sent, the API error of c2 only drops c2
+        self.assertEqual(api.calls, 3)
+        self.assertEqual(sorted(r['conv_id'] for r in results), ['c0', 'c3'])
+
+    def test_rate_limit_delay_maps_onto_a_token_bucket(self):
+        api = FakeApi()
+        chunks = [_journey(f'c{i}') for i in range(3)]
+
+        with _client(api) as client, \
+                mock.patch.object(api_utils, 'TokenBucket', wraps=api_utils.TokenBucket) as bucket:
+            start = time.monotonic()
+            results = api_utils.send_journeys_to_api(client, chunks, rate_limit_delay=0.1)
+            elapsed = time.monotonic() - start
+
+        bucket.assert_called_once_with(10.0, capacity=1)
+        self.assertEqual(len(results), 3)
+        # The first chunk goes out at once, each later one waits for a token
+        self.assertGreaterEqual(elapsed, 0.18)
+
+class ComputeIhcCacheTest(unittest.TestCase):
+    def setUp(self):
+        api_utils._read_cached_response.cache_clear()
+        self.addCleanup(api_utils._read_cached_response.cache_clear)
+
+    def test_cache_hit_sends_no_request(self):
+        api = FakeApi()
+
+        with tempfile.TemporaryDirectory() as cache_dir, _client(api, cache_dir=cache_dir) as client:
+            first = client.compute_ihc(_journey('c1'))
+            second = client.compute_ihc(_journey('c1'))
+            # Also a hit when the decoded response is no longer held in memory
+            api_utils._read_cached_response.cache_clear()
+            third = client.compute_ihc(_journey('c1'))
+
+        self.assertEqual(api.calls, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(first, third)
+
+    def test_corrupt_cache_entry_falls_back_to_the_api(self):
+        api = FakeApi()
+
+        with tempfile.TemporaryDirectory() as cache_dir, _client(api, cache_dir=cache_dir) as client:
+            body = orjson.dumps({'customer_journeys': _journey('c1')}, option=orjson.OPT_SORT_KEYS)
+            cache_path = client._get_cache_path(body)
+            cache_path.write_bytes(b'{"statusCode": 2')
+
+            with self.assertLogs(level='WARNING'):
+                result = client.compute_ihc(_journey('c1'))
+
+        self.assertEqual(api.calls, 1)
+        self.assertEqual(result['statusCode'], 200)
+
+if __name__ == '__main__':
+    unittest.main()
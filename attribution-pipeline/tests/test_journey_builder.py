@@ -0,0 +1,97 @@
+import unittest
+from unittest import mock
+
+from fixture_db import make_connection
+
+import pandas as pd
+
+import db_utils
+import journey_builder
+
+def _journeys(conn):
+    conversions_df = db_utils.get_conversions(conn)
+    return journey_builder.build_customer_journeys(conn, conversions_df, max_workers=1)
+
+class ParseTimestampsTest(unittest.TestCase):
+    def test_times_parse_like_strptime(self):
+        times = ['01:00:00', '23:59:59', '1:00:00', '12:0:00', '25:00:00', 'ab:cd:ef', '', '12:00:00']
+        dates = ['2023-01-02'] * 7 + ['2023-02-30']
+
+        parsed = journey_builder.parse_timestamps(
+            pd.Series(dates, index=range(10, 18)), pd.Series(times, index=range(10, 18))
+        )
+
+        self.assertEqual(list(parsed.index), list(range(10, 18)))
+        self.assertEqual(
+            [None if pd.isna(ts) else str(ts) for ts in parsed],
+            [
+                '2023-01-02 01:00:00', '2023-01-02 23:59:59',
+                '2023-01-02 01:00:00', '2023-01-02 12:00:00',
+                None, None, None, None,
+            ]
+        )
+
+class ConversionFlagTest(unittest.TestCase):
+    def test_first_session_tied_at_the_latest_timestamp_is_the_conversion_session(self):
+        conn = make_connection(
+            conversions=[('c1', 'u1', '2023-01-04', '13:00:00', 10.0)],
+            sessions=[
+                ('s1', 'u1', '2023-01-04', '10:00:00', 'Direct'),
+                ('s2', 'u1', '2023-01-04', '12:00:00', 'Direct'),
+                ('s3', 'u1', '2023-01-04', '12:00:00', 'Email'),
+            ]
+        )
+
+        journeys = _journeys(conn)
+
+        self.assertEqual(
+            [(s['session_id'], s['conversion']) for s in journeys],
+            [('s1', 0), ('s2', 1), ('s3', 0)]
+        )
+
+class SessionAssignmentTest(unittest.TestCase):
+    # u1 converts twice; s3 happens exactly at c1's time, so it is not before c1 and
+    # belongs to c2. u2's s4 goes to c3, which leaves c4 without a session, and s5
+    # comes after all of u2's conversions.
+    CONVERSIONS = [
+        ('c1', 'u1', '2023-01-01', '12:00:00', 100.0),
+        ('c2', 'u1', '2023-01-03', '08:00:00', 50.0),
+        ('c3', 'u2', '2023-01-02', '09:00:00', 20.0),
+        ('c4', 'u2', '2023-01-02', '10:00:00', 20.0),
+    ]
+    SESSIONS = [
+        ('s1', 'u1', '2023-01-01', '10:00:00', 'Direct'),
+        ('s2', 'u1', '2023-01-02', '09:00:00', 'Email'),
+        ('s3', 'u1', '2023-01-01', '12:00:00', 'Direct'),
+        ('s4', 'u2', '2023-01-02', '08:59:59', 'Email'),
+        ('s5', 'u2', '2023-01-02', '11:00:00', 'Direct'),
+    ]
+    EXPECTED = [
+        ('c1', 's1', '2023-01-01 10:00:00', 1),
+        ('c3', 's4', '2023-01-02 08:59:59', 1),
+        ('c2', 's3', '2023-01-01 12:00:00', 0),
+        ('c2', 's2', '2023-01-02 09:00:00', 1),
+    ]
+
+    def _assigned(self):
+        conn = make_connection(self.CONVERSIONS, self.SESSIONS)
+        return [
+            (s['conversion_id'], s['session_id'], s['timestamp'], s['conversion'])
+            for s in _journeys(conn)
+        ]
+
+    def test_sessions_belong_to_the_earliest_later_conversion(self):
+        self.assertEqual(self._assigned(), self.EXPECTED)
+
+    def test_batches_of_one_conversion_give_the_same_journeys(self):
+        # Every conversion in its own batch, so the claimed-until windows decide which
+        # sessions are still unassigned, including s3 on c1's exact timestamp
+        with mock.patch.object(journey_builder, 'JOURNEY_BATCH_SIZE', 1):
+            self.assertEqual(self._assigned(), self.EXPECTED)
+
+    def test_conversion_without_sessions_has_no_journey(self):
+        # s4 is c3's and s5 comes after c4
+        self.assertNotIn('c4', {conv_id for conv_id, *_ in self._assigned()})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import os
+import tempfile
+import unittest
+
+from fixture_db import make_connection
+
+import reporting
+
+# Sessions on both sides of the January/February boundary; s3 has no cost row
+CONVERSIONS = [
+    ('c1', 'u1', '2023-02-02', '12:00:00', 100.0),
+    ('c2', 'u2', '2023-02-02', '12:00:00', 50.0),
+]
+SESSIONS = [
+    ('s1', 'u1', '2023-01-31', '23:59:59', 'Direct'),
+    ('s2', 'u1', '2023-02-01', '00:00:00', 'Email'),
+    ('s3', 'u2', '2023-02-01', '10:00:00', 'Direct'),
+]
+COSTS = [('s1', 2.0), ('s2', 3.0)]
+C1_ATTRIBUTION = [('c1', 's1', 0.25), ('c1', 's2', 0.75)]
+C2_ATTRIBUTION = [('c2', 's3', 1.0)]
+
+# (channel_name, date, cost, ihc, ihc_revenue) with both conversions attributed
+EXPECTED_REPORT = [
+    ('Direct', '2023-01-31', 2.0, 0.25, 25.0),
+    ('Direct', '2023-02-01', 0.0, 1.0, 50.0),
+    ('Email', '2023-02-01', 3.0, 0.75, 75.0),
+]
+
+def _make_connection(attribution):
+    conn = make_connection(CONVERSIONS, SESSIONS, COSTS)
+    conn.executemany("INSERT INTO attribution_customer_journey VALUES (?, ?, ?)", attribution)
+    return conn
+
+def _report(conn):
+    return [tuple(row) for row in conn.execute("SELECT * FROM channel_reporting ORDER BY channel_name, date")]
+
+def _watermark(conn):
+    row = conn.execute("SELECT value FROM cr_metadata WHERE key = 'last_acj_rowid'").fetchone()
+    return row[0] if row else None
+
+class MonthSlicesTest(unittest.TestCase):
+    def test_short_range_is_one_slice(self):
+        self.assertEqual(
+            reporting._month_slices('2023-01-15', '2023-02-15'),
+            [('2023-01-15', '2023-02-15')]
+        )
+
+    def test_long_range_is_split_at_month_boundaries(self):
+        self.assertEqual(
+            reporting._month_slices('2023-12-31', '2024-02-29'),
+            [('2023-12-31', '2023-12-31'), ('2024-01-01', '2024-01-31'), ('2024-02-01', '2024-02-29')]
+        )
+
+class CreateChannelReportingTest(unittest.TestCase):
+    def test_month_sliced_range_covers_the_boundary_dates(self):
+        conn = _make_connection(C1_ATTRIBUTION + C2_ATTRIBUTION)
+
+        reporting.create_channel_reporting(conn, '2023-01-01', '2023-03-31')
+
+        self.assertEqual(_report(conn), EXPECTED_REPORT)
+        # Explicit ranges leave the incremental watermark alone
+        self.assertIsNone(_watermark(conn))
+
+    def test_range_excludes_dates_outside_it(self):
+        conn = _make_connection(C1_ATTRIBUTION + C2_ATTRIBUTION)
+
+        reporting.create_channel_reporting(conn, '2023-02-01', '2023-02-01')
+
+        self.assertEqual(_report(conn), EXPECTED_REPORT[1:])
+
+    def test_invalid_date_leaves_no_open_transaction(self):
+        conn = _make_connection(C1_ATTRIBUTION)
+
+        with self.assertRaises(ValueError):
+            reporting.create_channel_reporting(conn, '2023-01-01', '2023-13-01')
+
+        self.assertFalse(conn.in_transaction)
+
+    def test_incremental_runs_only_recompute_dates_with_new_attributions(self):
+        conn = _make_connection(C1_ATTRIBUTION)
+        reporting.create_channel_reporting(conn)
+        self.assertEqual(_report(conn), [EXPECTED_REPORT[0], EXPECTED_REPORT[2]])
+        self.assertEqual(_watermark(conn), '2')
+
+        # A stale row on a date without new attributions shows which dates are recomputed
+        conn.execute("UPDATE channel_reporting SET cost = 99.0 WHERE date = '2023-01-31'")
+        conn.executemany("INSERT INTO attribution_customer_journey VALUES (?, ?, ?)", C2_ATTRIBUTION)
+        reporting.create_channel_reporting(conn)
+
+        self.assertEqual(_report(conn), [('Direct', '2023-01-31', 99.0, 0.25, 25.0)] + EXPECTED_REPORT[1:])
+        self.assertEqual(_watermark(conn), '3')
+
+        # Nothing new: the run changes nothing
+        reporting.create_channel_reporting(conn)
+        self.assertEqual(_watermark(conn), '3')
+
+        # Without the watermark the next run rebuilds every date
+        conn.execute("DELETE FROM cr_metadata")
+        reporting.create_channel_reporting(conn)
+        self.assertEqual(_report(conn), EXPECTED_REPORT)
+
+class ExportChannelReportingTest(unittest.TestCase):
+    def test_streamed_csv_matches_the_dataframe_export(self):
+        conn = _make_connection(C1_ATTRIBUTION + C2_ATTRIBUTION)
+        reporting.create_channel_reporting(conn)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            streamed_path = os.path.join(tmp, 'streamed.csv')
+            frame_path = os.path.join(tmp, 'frame.csv')
+            row_count = reporting.export_channel_reporting_with_metrics(conn, streamed_path, return_df=False)
+            df = reporting.export_channel_reporting_with_metrics(conn, frame_path)
+
+            with open(streamed_path, 'rb') as f:
+                streamed = f.read()
+            with open(frame_path, 'rb') as f:
+                frame = f.read()
+
+        self.assertEqual(row_count, 3)
+        self.assertEqual(len(df), 3)
+        self.assertEqual(streamed, frame)
+        # Zero cost leaves ROAS empty instead of dividing by zero
+        self.assertIn(b'Direct,2023-02-01,0.0,1.0,50.0,0.0,' + os.linesep.encode(), streamed)
+
+if __name__ == '__main__':
+    unittest.main()